@@ -1,24 +1,34 @@
 """
 This script processes forecast and hindcast data from the ECMWF SEAS5 model
-to calculate and visualise precipitation anomalies for Spanish basins.
+(or the system given by ORIGIN and SYSTEM, set by ingest_daemon.py) to calculate and visualise precipitation anomalies for Spanish basins.
 
 STEP1. Define main characteristics of the input data
     1.1 Sets up the basic configuration for the ECMWF SEAS5 model.
     1.2 Iterates over some forecast year (2022, 2023, 2024)
 
 STEP2. Load Hindcast and Forecast Data (GRIB format) and sets up the time and coordinate system.
+    Only the GRIB messages of the NDJFM forecastMonths are decoded (grib_index.py).
 
 STEP3. Make some computations in the data
     3.1 Convert Precipitation Units from m/s to l/m² 
+        Optional quantile-mapping bias correction against ERA5 (config['bias_obs']).
     3.2 Calculate Winter Precipitation Mean an extended winter period (from November to March).
     3.3 Reshape Hindcast Dimensions to make them compatible with anomaly calculations.
 
 STEP4. Compute Precipitation Anomalies for each basin by comparing hindcast and forecast values.
+    Members and start dates are processed in blocks sized to config['memory_budget'].
+    The hindcast moments come from the climatology of the start month (climatology.py),
+    updated only with the start dates it does not have yet.
 
 STEP5. Compute and Save Statistics for each anomaly period and saves them in a CSV file.
 
 STEP6. Visualise Results
  - Generates a boxplot for precipitation anomalies and a table with calculated statistics.
+ - All the basins and years go to one PDF and/or HTML report (report.py); the
+   per-basin PNGs are only written when config['export_png'] is set.
+
+STEP7. Anomaly maps
+ - Ensemble-mean relative anomaly maps of every forecast year with the basin outlines (map_render.py).
 
 """
 
@@ -34,6 +44,19 @@ import matplotlib
 from matplotlib import pyplot as plt
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
+from anomalies import COMPACT_DTYPE, blocked_basin_anomalies, anomaly_stats, ensemble_mean_anomaly
+from basins import load_basin_points
+from climatology import Climatology, start_date_labels
+from products import save_basin_products, save_grid_product, climatology_dir, cache_key
+from hierarchy import basin_tree, aggregate_hierarchy, node_key
+from bootstrap import bootstrap_confidence_intervals
+from spi import GammaParameters, fit_grid, grid_spi, basin_spi
+from quantile_mapping import QuantileMap, fit_quantile_map, match_grid
+from map_render import render_maps
+from report import BasinReport, parse_formats
+from grib_index import NDJFM_MONTHS, open_grib_selection
+from grib_parallel import open_grib_parallel, parallel_decoding
+from units import convert_units
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -43,13 +66,14 @@ warnings.filterwarnings('ignore')
 print('STEP1. Define main characteristics of the input data')
 
 # 1.1 Sets up the basic configuration for the ECMWF SEAS5 model.
-institution = 'ECWMF'
-name = 'SEAS5'
-startmonth = 10
-year=[2022,2023,2024]
+startmonth = int(os.getenv('START_MONTH', 10))
+year=[int(y) for y in os.getenv('FORECAST_YEARS', '2022,2023,2024').split(',')]  # set by ingest_daemon.py
+model = os.getenv('ORIGIN', 'ecmwf')  # origin and system of the GRIB file names, set by ingest_daemon.py
+system = os.getenv('SYSTEM', '51')
+institution, name = ('ECWMF', 'SEAS5') if (model, system) == ('ecmwf', '51') else (model.upper(), f's{system}')
 origin_labels = {'institution': institution, 'name': name}
-model = 'ecmwf'
-system = '51'
+model_label = f"{institution} {name}"  # titles
+model_tag = f"{institution}_{name}"  # output file names
 fcmonth = 1
 
 config = dict(
@@ -60,9 +84,24 @@ config = dict(
     start_month = startmonth,
     origin = model,
     system = system,
-    isLagged = False if model in ['ecmwf', 'meteo_france', 'dwd', 'cmcc', 'eccc'] else True
+    isLagged = False if model in ['ecmwf', 'meteo_france', 'dwd', 'cmcc', 'eccc'] else True,
+    memory_budget = os.getenv('MEMORY_BUDGET', '4GB'),  # memory for the anomaly and statistics blocks
+    decode_workers = int(os.getenv('DECODE_WORKERS', os.cpu_count())),  # processes decoding GRIB messages
+    anomaly_index = os.getenv('ANOMALY_INDEX', 'percent'),  # 'percent' (relative anomaly) or 'spi'
+    bias_obs = os.getenv('BIAS_CORRECTION_OBS'),  # ERA5 monthly precipitation on the model grid (None: no bias correction)
+    report_formats = parse_formats(os.getenv('REPORT_FORMATS', 'pdf')),  # report of all the basins and years: pdf and/or html
+    export_png = os.getenv('EXPORT_PNG', 'false').lower() in ('1', 'true', 'yes')  # also one PNG per basin and year
 )
 
+# Basin products and cached climatology fits (also read by query_service.py and ingest_daemon.py)
+products_dir = os.getenv('PRODUCTS_DIR', '/sclim/cly/basins/results-basins/products')
+
+
+# Ensemble-mean anomaly maps of every year, rendered together in STEP7
+map_jobs = []
+
+# Boxplots and tables of all the basins and years, written as one document after the loop
+report = BasinReport(f"Precipitation Anomaly - Model: {model_label} - Startmonth: {startmonth} - Period: Extended Winter (NDJFM)")
 
 # 1.2 Iterates over some forecast year (2022, 2023, 2024)
 for forecast_year in config['fcy']:
@@ -75,33 +114,28 @@ for forecast_year in config['fcy']:
 
     # paths grib of 1º horizontal resolution
     HINDDIR="/MASIVO/cly/Seasonal_Verification/1-Sf_variables/data"
-    FOREDIR="/MASIVO/cly/Forecast/1-Default_forecast/grib-data"
+    FOREDIR=os.getenv('FOREDIR', "/MASIVO/cly/Forecast/1-Default_forecast/grib-data")
 
 
     # Open climatology
     hcst_bname = '{origin}_s{system}_stmonth{start_month:02d}_hindcast{hcstarty}-{hcendy}_monthly'.format(**config)
     hcst_fname = f'{HINDDIR}/{hcst_bname}.grib'
+    # The hindcast can also be split in per-year files (directory or glob pattern)
+    hcst_source = os.getenv('HINDCAST_SOURCE', hcst_fname)
 
 
 
 
 
-    st_dim_name = 'time' if not config.get('isLagged',False) else 'indexing_time'
-
+    # Only the tprate messages of the NDJFM forecastMonths are decoded
+    if config['start_month'] not in NDJFM_MONTHS:
+        raise ValueError("start_month must be either 10 or 11")
+    season_months = NDJFM_MONTHS[config['start_month']]
 
     print('Reading HCST data from file')
-    hcst = xr.open_dataset(hcst_fname,engine='cfgrib', backend_kwargs=dict(time_dims=('forecastMonth', st_dim_name)))
-    hcst = hcst.chunk({'forecastMonth':1, 'latitude':'auto', 'longitude':'auto'})  #force dask.array using chunks on leadtime, latitude and longitude coordinate
-    hcst = hcst.rename({'latitude':'lat','longitude':'lon', st_dim_name:'start_date'})
-
-    print ('Re-arranging time metadata in xr.Dataset object')
-    # Add start_month to the xr.Dataset
-    start_month = pd.to_datetime(hcst.start_date.values[0]).month
-    hcst = hcst.assign_coords({'start_month':start_month})
-    # Add valid_time to the xr.Dataset
-    vt = xr.DataArray(dims=('start_date','forecastMonth'), coords={'forecastMonth':hcst.forecastMonth,'start_date':hcst.start_date})
-    vt.data = [[pd.to_datetime(std)+relativedelta(months=fcmonth-1) for fcmonth in vt.forecastMonth.values] for std in vt.start_date.values]
-    hcst = hcst.assign_coords(valid_time=vt)
+    # start_date, start_month and valid_time coordinates are set by the loader
+    hcst = open_grib_parallel(hcst_source, ['tprate'], season_months, lagged=config.get('isLagged',False),
+                              max_workers=config['decode_workers'])
 
 
 
@@ -111,36 +145,13 @@ for forecast_year in config['fcy']:
     fcst_bname = f"{config['origin']}_s{config['system']}_stmonth{config['start_month']:02d}_forecast{forecast_year}_monthly"
     fcst_fname = f'{FOREDIR}/{fcst_bname}.grib'
     print(f"Forecast file name for year {forecast_year}: {fcst_bname}")
-    st_dim_name = 'time' if not config.get('isLagged',False) else 'indexing_time'
-    fcst = xr.open_dataset(fcst_fname,engine='cfgrib', backend_kwargs=dict(time_dims=('forecastMonth', st_dim_name)))
-    fcst = fcst.chunk({'forecastMonth':1, 'latitude':'auto', 'longitude':'auto'})
-    fcst = fcst.rename({'latitude':'lat','longitude':'lon', st_dim_name:'start_date'})
-    # Add start_month to the xr.Dataset
-    start_month = pd.to_datetime(fcst.start_date.values).month
-    fcst = fcst.assign_coords({'start_month':start_month})
-    # Add valid_time to the xr.Dataset
-    vt = xr.DataArray(dims=('forecastMonth',), coords={'forecastMonth': fcst.forecastMonth})
-    vt.data = [pd.to_datetime(fcst.start_date.values)+relativedelta(months=fcmonth-1) for fcmonth in fcst.forecastMonth.values]
-    fcst = fcst.assign_coords(valid_time=vt)
+    fcst = open_grib_selection(fcst_fname, ['tprate'], season_months, lagged=config.get('isLagged',False))
 
     ####################################################################
     # STEP3. Make some computations in the data
 
     # 3.1 Convert Precipitation Units from m/s to l/m²
-    def convert_precip_units(data):
-        """
-        This function converts precipitation units from m/s to l/m^2.
-        :data: matrix of precipitation
-        :return: matrix of precipitation in l/m^2
-        """ 
-        #seconds_per_day = 86400
-        #days_in_month = {1: 31, 2: 29 if leap_year else 28, 3: 31, 4: 30, 5: 31, 6: 30, 
-        #                7: 31, 8: 31, 9: 30, 10: 31, 11: 30, 12: 31}
-        # meters per sencond to meters per month
-        data_m_month = data * 86400 * 30
-        # meters per month to mm per month
-        solution = data_m_month *1000                     
-        return solution
+    # The conversion of each variable is registered in units.py (UNIT_CONVERSIONS)
 
 
 
@@ -153,8 +164,39 @@ for forecast_year in config['fcy']:
     # hcst-Dimensions: (number: 25, forecastMonth: 6, start_date: 24, lat: 46, lon: 91)
     # fcst-Dimensions: (number: 51, forecastMonth: 6, lat: 180, lon: 360)
 
-    hcst_lm2=convert_precip_units(hcst['tprate'])
-    fcst_lm2=convert_precip_units(fcst['tprate'])
+    # Keep the data in the compact dtype (the conversion factors do not promote it)
+    hcst_lm2=convert_units(hcst.astype(COMPACT_DTYPE))['tprate']
+    fcst_lm2=convert_units(fcst.astype(COMPACT_DTYPE))['tprate']
+
+    # The cached fits of the start month are keyed on the grid and on the bias
+    # correction, so changing either never reuses a stale fit
+    clim_dir = climatology_dir(products_dir, startmonth)
+    grid_id = [np.round(hcst_lm2['lat'].values, 4).tolist(), np.round(hcst_lm2['lon'].values, 4).tolist()]
+    hcst_id = [start_date_labels(hcst_lm2['start_date'].values), hcst_lm2.sizes['number']]  # start dates and members
+    data_source = cache_key(grid_id, None)
+
+    # Bias correction: quantile maps of the hindcast vs ERA5 of every cell and
+    # forecastMonth, cached per start month, grid, ERA5 file and hindcast samples
+    # (a hindcast with new start dates or members is fitted again). The hindcast is
+    # corrected too so both distributions are compared in the same (observed)
+    # space. The correction is lazy and runs block by block in STEP4.
+    if config['bias_obs']:
+        obs_id = [os.path.abspath(config['bias_obs']), os.path.getmtime(config['bias_obs'])]
+        qmap_file = os.path.join(clim_dir, f'quantile_map_{cache_key(grid_id, obs_id, hcst_id)}.npz')
+        if os.path.exists(qmap_file):
+            qmap = QuantileMap.load(qmap_file)
+        else:
+            era5 = xr.open_dataset(config['bias_obs']).rename({'latitude': 'lat', 'longitude': 'lon'})
+            # Nearest ERA5 cell within half a model cell, longitudes in the convention of the model grid
+            era5_lm2 = match_grid(convert_units(era5, ['tp'])['tp'], hcst_lm2['lat'].values, hcst_lm2['lon'].values)
+            with parallel_decoding(config['decode_workers']):
+                qmap = fit_quantile_map(hcst_lm2, era5_lm2, config['memory_budget'])
+            os.makedirs(os.path.dirname(qmap_file), exist_ok=True)
+            qmap.save(qmap_file)
+        # Fits of the corrected data depend on the quantile map in use
+        data_source = cache_key(grid_id, os.path.basename(qmap_file), os.path.getmtime(qmap_file))
+        hcst_lm2 = qmap.apply(hcst_lm2)
+        fcst_lm2 = qmap.apply(fcst_lm2)
 
     # 3.2 Calculate Winter Precipitation Mean an extended winter period (from November to March).
 
@@ -183,139 +225,183 @@ for forecast_year in config['fcy']:
 
     
     path_to_csv_files = '/sclim/cly/basins/results-basins'
-
-    # Loop over the basins
-    for i in range(1, 26):
-    file_name = f"grid_points_within_{i}.csv"
-    file_path = os.path.join(path_to_csv_files, file_name)
-    print(f"Processing file: {file_path}")
-
-    df = pd.read_csv(file_path)
-
-    if 'x_grid' in df.columns and 'y_grid' in df.columns:
-
-        points = list(zip(df['x_grid'], df['y_grid']))
-        
-        # Extract values in our lats lons
-        hcst_values = []
-        fcst_values = []
-        for x, y in points:
-            hcst_basin = winter_hcst_stacked.isel(lat=y, lon=x).values
-            hcst_values.append(hcst_basin)
-            fcst_basin = winter_fcst.isel(lat=y, lon=x).values
-            fcst_values.append(fcst_basin)
-
-        hcst_values = np.array(hcst_values)
-        fcst_values = np.array(fcst_values) 
-
-        # Calculate the mean and std deviation for normalization
-        hindcast_mean = hcst_values.mean(axis=1, keepdims=True)  # Shape: (points in basin, 1)
-        hindcast_std = hcst_values.std(axis=1, keepdims=True)    # Shape: (points in basin, 1)
-
-        forecast_mean = fcst_values.mean(axis=1, keepdims=True)  # Shape: (points in basin, 1)
-        forecast_std = fcst_values.std(axis=1, keepdims=True)    # Shape: (points in basin, 1)
-
-        # Normalize hcst_values and fcst_values
-        hcst_norm = (hcst_values - hindcast_mean) / hindcast_std
-        fcst_norm = (fcst_values - forecast_mean) / forecast_std
-
-        # Relative anomaly
-        hindcast_anomaly = (hcst_values - hindcast_mean) / hindcast_mean * 100
-        forecast_anomaly = (fcst_values - hindcast_mean) / hindcast_mean * 100
-
-        print("Hindcast relative shape:", hindcast_anomaly.shape)
-        print("Forecast relative shape:", forecast_anomaly.shape)
-
-    # Compute the mean for the basin points
-    hindcast_anomaly_basinmean=hindcast_anomaly.mean(axis=0)
-    forecast_anomaly_basinmean=forecast_anomaly.mean(axis=0)
-
-    ####################################################################
-    # STEP5. Compute and Save Statistics
-
-    # Compute statistics for hindcast and forecast anomalies
-    hindcast_stats = {
-        "95th Percentile": np.percentile(hindcast_anomaly_basinmean, 95),
-        "75th Percentile (Q3)": np.percentile(hindcast_anomaly_basinmean, 75),
-        "Median (Q2)": np.percentile(hindcast_anomaly_basinmean, 50),
-        "25th Percentile (Q1)": np.percentile(hindcast_anomaly_basinmean, 25),
-        "5th Percentile": np.percentile(hindcast_anomaly_basinmean, 5),
-        "Basin precip mean (l/m^2)": hcst_values.mean(),
-        "Basin precip std (l/m^2)": hcst_values.std()
-    }
-
-    forecast_stats = {
-        "95th Percentile": np.percentile(forecast_anomaly_basinmean, 95),
-        "75th Percentile (Q3)": np.percentile(forecast_anomaly_basinmean, 75),
-        "Median (Q2)": np.percentile(forecast_anomaly_basinmean, 50),
-        "25th Percentile (Q1)": np.percentile(forecast_anomaly_basinmean, 25),
-        "5th Percentile": np.percentile(forecast_anomaly_basinmean, 5),
-        "Basin precip mean (l/m^2)": fcst_values.mean(),
-        "Basin precip std (l/m^2)": fcst_values.std()
-    }
-
-    # Combine statistics into a DataFrame for easy display in the table
-    stats_df = pd.DataFrame({
-        f"Reference 1993-2016": hindcast_stats,
-        f"Forecast {forecast_year}/{forecast_year + 1}": forecast_stats})
-
-    # Round to two decimal places for display
-    stats_df = stats_df.round(2)
-
-    # Save the statistics to a CSV file
-    output_results = '/sclim/cly/basins/results-basins/'
-    output_csv = f'{output_results}HindcastForecast_stats_basin_{i}_ECWMF_SEAS5_stmonth_{startmonth}_NDJFM_{forecast_year}.csv'
-    stats_df.to_csv(output_csv, index_label="Statistic")
-    print(f"Statistics saved at {output_csv}")
-
-    ####################################################################
-    #STEP6. Visualise Results
-    # Create a figure with subplots: one for the boxplot and one for the statistics table
-    fig, (ax_box, ax_table) = plt.subplots(1, 2, figsize=(14, 6), gridspec_kw={"width_ratios": [2, 1]})
-    fig.subplots_adjust(top=0.8, wspace=0.5)  # Increase space between subplots
-    fig.suptitle(f"Precipitation Anomaly\nBasin: {df['basin_name'][0]}\nStartmonth: {startmonth} Period: Extended Winter (NDJFM)\n Model: ECWMF SEAS5", fontsize=14)
-
-    # Customize boxplot
-    ax_box.boxplot([hindcast_anomaly_basinmean, forecast_anomaly_basinmean], 
-                labels=[f"Reference\n1993-2016", f"Forecast\n{forecast_year}/{forecast_year +1}"], 
-                widths=0.4,
-                patch_artist=True,
-                boxprops=dict(facecolor="lightblue", color="darkblue"),
-                medianprops=dict(color="orange", linewidth=1.5),
-                whiskerprops=dict(color="darkblue"),
-                capprops=dict(color="darkblue"),
-                flierprops=dict(marker="o", color="darkblue", markersize=5),
-                showfliers=False 
-    )
-    ax_box.set_ylabel("Precipitation Anomaly (%)", fontsize=12)
-    #ax_box.set_xlabel("Period", fontsize=12)
-
-    # Table displaying statistics next to the boxplot
-    ax_table.axis("off")  # Turn off axis
-    table = ax_table.table(cellText=stats_df.values, 
-                        colLabels=[f'Reference\n1993-2016', f'Forecast\n{forecast_year}/{forecast_year + 1}'], 
-                        rowLabels=stats_df.index, 
-                        cellLoc="center", 
-                        loc="center",
-                        colColours=["#cfe2f3", "#ffdfba"])  # Column colors
-
-    # Customize table appearance
-    table.auto_set_font_size(False)
-    table.set_fontsize(10)
-    table.scale(1.5, 1.5)  
-    table.auto_set_column_width(col=list(range(len(stats_df.columns))))
-
-    # Adjust table header font
-    for key, cell in table.get_celld().items():
-        if key[0] == 0:  # Header row
-            cell.set_fontsize(12)
-            cell.set_text_props(weight="bold")
-            cell.set_height(0.1)
-
-    # Save the plot with the table
-    output_results = '/sclim/cly/basins/results-basins/'
-    output_file = f'HindcastForecast_basin_{i}_ECWMF_SEAS5_stmonth_{startmonth}_NDJFM_{forecast_year}_noflies.png'
-    plt.savefig(f"{output_results}{output_file}", dpi=300, bbox_inches="tight")
-    plt.close()
-
-    print(f"Plot saved at {output_results}{output_file}")
+    basin_points = load_basin_points(path_to_csv_files)
+
+    # Hindcast climatology of the start month: only the start dates and members
+    # not recorded yet are read, and it is rebuilt if the hindcast, the basins or
+    # the bias correction changed
+    clim = None
+    if os.path.exists(os.path.join(clim_dir, 'climatology.json')):
+        clim = Climatology.load(clim_dir)
+        if not clim.matches(winter_hcst, basin_points, source=data_source):
+            print("The hindcast, the basins or the bias correction changed, rebuilding the climatology")
+            clim = None
+    if clim is None:
+        clim = Climatology((winter_hcst.sizes['lat'], winter_hcst.sizes['lon']), basin_points, source=data_source)
+    with parallel_decoding(config['decode_workers']):
+        if clim.update_from_hindcast(winter_hcst, config['memory_budget']):
+            clim.save(clim_dir)
+
+    # Anomalies of all the basins, processing members and start dates in blocks
+    # that fit in the memory budget; the hindcast moments come from the climatology
+    # The GRIB messages of each block are decoded in a pool of processes
+    with parallel_decoding(config['decode_workers']):
+        basin_results = blocked_basin_anomalies(winter_hcst_stacked, winter_fcst, basin_points,
+                                                config['memory_budget'], dtype=COMPACT_DTYPE,
+                                                hcst_moments=clim.grid_moments)
+
+    # Save the basin anomalies as products for query_service.py
+    save_basin_products(products_dir, startmonth, forecast_year, basin_points, basin_results)
+
+    # Ensemble-mean relative anomaly of every grid cell for the maps of STEP7
+    # (hindcast mean from the climatology, only the forecast is read)
+    with parallel_decoding(config['decode_workers']):
+        anomaly_map = ensemble_mean_anomaly(clim.grid_moments.mean, winter_fcst)
+    map_jobs.append((anomaly_map.values,
+                     f"Precipitation Anomaly (ensemble mean)\nStartmonth: {startmonth} Period: Extended Winter (NDJFM) {forecast_year}/{forecast_year + 1}\n Model: {model_label}",
+                     f'/sclim/cly/basins/results-basins/AnomalyMap_{model_tag}_stmonth_{startmonth}_NDJFM_{forecast_year}.png'))
+    map_grid = dict(lats=anomaly_map['lat'].values, lons=anomaly_map['lon'].values)
+
+    # Vertientes and the whole country, rolled up from the basin partial sums
+    group_results = aggregate_hierarchy(basin_results, basin_tree())
+    areas = [(i, points['name'], basin_results[i]) for i, points in basin_points.items()]
+    areas += [(node_key(name), name, results) for name, results in group_results.items()]
+
+    # SPI mode: gamma fits of the hindcast (cached per start month, grid, bias
+    # correction and hindcast start dates and members) and SPI of the forecast members
+    if config['anomaly_index'] == 'spi':
+        grid_params_file = os.path.join(clim_dir, f'spi_gamma_grid_{cache_key(data_source, hcst_id)}.npz')
+        if os.path.exists(grid_params_file):
+            grid_params = GammaParameters.load(grid_params_file)
+        else:
+            with parallel_decoding(config['decode_workers']):
+                grid_params = fit_grid(winter_hcst_stacked, config['memory_budget'])
+            os.makedirs(clim_dir, exist_ok=True)
+            grid_params.save(grid_params_file)
+        with parallel_decoding(config['decode_workers']):
+            forecast_spi = grid_spi(winter_fcst, grid_params, config['memory_budget'], dtype=COMPACT_DTYPE)
+        save_grid_product(products_dir, startmonth, forecast_year, 'forecast_spi', forecast_spi)
+
+        # The basin series become the SPI of the basin means
+        area_spi, _ = basin_spi({i: results for i, _, results in areas})
+        areas = [(i, name, dict(results,
+                                hindcast_anomaly_basinmean=area_spi[i]['hindcast_spi'],
+                                forecast_anomaly_basinmean=area_spi[i]['forecast_spi']))
+                 for i, name, results in areas]
+    index_label = "SPI" if config['anomaly_index'] == 'spi' else "Precipitation Anomaly (%)"
+    index_suffix = "_spi" if config['anomaly_index'] == 'spi' else ""
+
+    # 90% bootstrap confidence intervals of the statistics of all the areas at once
+    confidence_intervals = bootstrap_confidence_intervals({i: results for i, _, results in areas},
+                                                          n_replicates=2000, confidence=0.90, seed=0)
+
+    # Loop over the basins, vertientes and the whole country
+    for i, name, anomalies in areas:
+        print(f"Processing basin {i}: {name}")
+
+        # Mean over the basin points
+        hindcast_anomaly_basinmean = anomalies['hindcast_anomaly_basinmean']
+        forecast_anomaly_basinmean = anomalies['forecast_anomaly_basinmean']
+
+        ####################################################################
+        # STEP5. Compute and Save Statistics
+
+        # Compute statistics for hindcast and forecast anomalies
+        hindcast_stats = anomaly_stats(hindcast_anomaly_basinmean, anomalies['hcst_mean'], anomalies['hcst_std'])
+        forecast_stats = anomaly_stats(forecast_anomaly_basinmean, anomalies['fcst_mean'], anomalies['fcst_std'])
+
+        # Combine statistics into a DataFrame for easy display in the table
+        stats_df = pd.DataFrame({
+            f"Reference 1993-2016": hindcast_stats,
+            f"Forecast {forecast_year}/{forecast_year + 1}": forecast_stats})
+
+        # Round to two decimal places for display
+        stats_df = stats_df.round(2)
+
+        # Save the statistics to a CSV file
+        output_results = '/sclim/cly/basins/results-basins/'
+        output_csv = f'{output_results}HindcastForecast{index_suffix}_stats_basin_{i}_{model_tag}_stmonth_{startmonth}_NDJFM_{forecast_year}.csv'
+        stats_df.to_csv(output_csv, index_label="Statistic")
+        print(f"Statistics saved at {output_csv}")
+
+        # Confidence intervals, with the hindcast also subsampled to the forecast ensemble size
+        ci_df = pd.DataFrame({f"{sample_set} {bound}": {stat: interval[n] for stat, interval in cis.items()}
+                              for sample_set, cis in confidence_intervals[i].items()
+                              for n, bound in enumerate(['low', 'high'])}).round(2)
+        output_ci_csv = output_csv.replace('_stats_', '_stats_ci90_')
+        ci_df.to_csv(output_ci_csv, index_label="Statistic")
+        print(f"Confidence intervals saved at {output_ci_csv}")
+
+        ####################################################################
+        #STEP6. Visualise Results
+        report.ylabel = index_label
+        report.add(f"Basin: {name}\nStartmonth: {startmonth} Period: Extended Winter (NDJFM) {forecast_year}/{forecast_year + 1}",
+                   {f"Reference\n1993-2016": hindcast_anomaly_basinmean,
+                    f"Forecast\n{forecast_year}/{forecast_year + 1}": forecast_anomaly_basinmean},
+                   stats_df, ci_df)
+        if not config['export_png']:
+            continue
+
+        # Optional PNG of the basin and year
+        # Create a figure with subplots: one for the boxplot and one for the statistics table
+        fig, (ax_box, ax_table) = plt.subplots(1, 2, figsize=(14, 6), gridspec_kw={"width_ratios": [2, 1]})
+        fig.subplots_adjust(top=0.8, wspace=0.5)  # Increase space between subplots
+        fig.suptitle(f"Precipitation Anomaly\nBasin: {name}\nStartmonth: {startmonth} Period: Extended Winter (NDJFM)\n Model: {model_label}", fontsize=14)
+
+        # Customize boxplot
+        ax_box.boxplot([hindcast_anomaly_basinmean, forecast_anomaly_basinmean], 
+                    labels=[f"Reference\n1993-2016", f"Forecast\n{forecast_year}/{forecast_year +1}"], 
+                    widths=0.4,
+                    patch_artist=True,
+                    boxprops=dict(facecolor="lightblue", color="darkblue"),
+                    medianprops=dict(color="orange", linewidth=1.5),
+                    whiskerprops=dict(color="darkblue"),
+                    capprops=dict(color="darkblue"),
+                    flierprops=dict(marker="o", color="darkblue", markersize=5),
+                    showfliers=False 
+        )
+        ax_box.set_ylabel(index_label, fontsize=12)
+        #ax_box.set_xlabel("Period", fontsize=12)
+
+        # Table displaying statistics next to the boxplot
+        ax_table.axis("off")  # Turn off axis
+        table = ax_table.table(cellText=stats_df.values, 
+                            colLabels=[f'Reference\n1993-2016', f'Forecast\n{forecast_year}/{forecast_year + 1}'], 
+                            rowLabels=stats_df.index, 
+                            cellLoc="center", 
+                            loc="center",
+                            colColours=["#cfe2f3", "#ffdfba"])  # Column colors
+
+        # Customize table appearance
+        table.auto_set_font_size(False)
+        table.set_fontsize(10)
+        table.scale(1.5, 1.5)  
+        table.auto_set_column_width(col=list(range(len(stats_df.columns))))
+
+        # Adjust table header font
+        for key, cell in table.get_celld().items():
+            if key[0] == 0:  # Header row
+                cell.set_fontsize(12)
+                cell.set_text_props(weight="bold")
+                cell.set_height(0.1)
+
+        # Save the plot with the table
+        output_results = '/sclim/cly/basins/results-basins/'
+        output_file = f'HindcastForecast{index_suffix}_basin_{i}_{model_tag}_stmonth_{startmonth}_NDJFM_{forecast_year}_noflies.png'
+        plt.savefig(f"{output_results}{output_file}", dpi=300, bbox_inches="tight")
+        plt.close()
+
+        print(f"Plot saved at {output_results}{output_file}")
+
+
+# One report with all the basins and years
+report.write(f'/sclim/cly/basins/results-basins/HindcastForecast{index_suffix}_report_{model_tag}_stmonth_{startmonth}_NDJFM',
+             config['report_formats'])
+
+
+####################################################################
+# STEP7. Anomaly maps
+# The coastlines, borders and basin outlines are projected once (cached next to
+# the basin geometry cache) and the maps of all the years are rendered in parallel
+render_maps(map_jobs, dict(map_grid, basins_cache_dir='/sclim/cly/basins/data-basins/geometry-cache'),
+            max_workers=config['decode_workers'])
@@ -0,0 +1,133 @@
+"""
+This script processes forecast and hindcast data from several seasonal
+forecasting systems (ECMWF, UK Met Office, DWD, Météo-France, CMCC) to
+calculate precipitation anomalies for Spanish basins for every system and for
+their multi-model ensemble (MME).
+
+STEP1. Define main characteristics of the input data
+    1.1 Systems, start month and forecast years (SYSTEMS, START_MONTH, FORECAST_YEARS).
+
+STEP2. Load Hindcast and Forecast Data of all the systems (multi_system.py)
+    Burst and lagged ensembles are normalised to (system, member, start_date, forecastMonth).
+
+STEP3. Make some computations in the data
+    3.1 Convert Precipitation Units from m/s to l/m²
+    3.2 Calculate Winter Precipitation Mean an extended winter period (NDJFM).
+
+STEP4. Compute Precipitation Anomalies of all the systems as one batched computation,
+    plus the MME, for every basin, vertiente and the whole country.
+
+STEP5. Compute and Save Statistics (and bootstrap confidence intervals) in CSV files.
+
+STEP6. One report with the boxplots and tables of every system, area and year.
+"""
+
+import os
+import pandas as pd
+from dotenv import load_dotenv
+from anomalies import COMPACT_DTYPE, anomaly_stats
+from basins import load_basin_points
+from hierarchy import basin_tree, aggregate_hierarchy, node_key
+from bootstrap import bootstrap_confidence_intervals
+from grib_index import NDJFM_MONTHS
+from grib_parallel import parallel_decoding
+from multi_system import SYSTEMS, MME, open_multi_system, multi_system_anomalies
+from report import BasinReport, parse_formats
+from units import convert_units
+
+load_dotenv()
+
+##########################################################
+#STEP1. Define main characteristics of the input data
+print('STEP1. Define main characteristics of the input data')
+
+startmonth = int(os.getenv('START_MONTH', 11))
+years = [int(y) for y in os.getenv('FORECAST_YEARS', '2022,2023,2024').split(',')]
+systems = os.getenv('SYSTEMS', 'ecmwf,ukmo,dwd,meteo_france,cmcc').split(',')
+
+config = dict(
+    hcstarty = 1993,
+    hcendy = 2016,
+    start_month = startmonth,
+    memory_budget = os.getenv('MEMORY_BUDGET', '4GB'),  # memory for the anomaly and statistics blocks
+    decode_workers = int(os.getenv('DECODE_WORKERS', os.cpu_count())),  # processes decoding GRIB messages
+    report_formats = parse_formats(os.getenv('REPORT_FORMATS', 'pdf'))
+)
+
+# paths grib of 1º horizontal resolution
+HINDDIR = os.getenv('HINDDIR', "/MASIVO/cly/Seasonal_Verification/1-Sf_variables/data")
+FOREDIR = os.getenv('FOREDIR', "/MASIVO/cly/Forecast/1-Default_forecast/grib-data")
+output_results = '/sclim/cly/basins/results-basins/'
+
+if config['start_month'] not in NDJFM_MONTHS:
+    raise ValueError("start_month must be either 10 or 11")
+season_months = NDJFM_MONTHS[config['start_month']]
+
+basin_points = load_basin_points('/sclim/cly/basins/results-basins')
+
+report = BasinReport(f"Precipitation Anomaly - Multi-system - Startmonth: {startmonth} - Period: Extended Winter (NDJFM)")
+
+
+####################################################################
+# STEP2. Load Hindcast Data of all the systems (shared by the forecast years)
+print("STEP2. Load Hindcast and Forecast Data")
+hcst_sources = {name: '{hinddir}/{origin}_s{system}_stmonth{start_month:02d}_hindcast{hcstarty}-{hcendy}_monthly.grib'.format(
+                    hinddir=HINDDIR, **SYSTEMS[name], **config)
+                for name in systems}
+hcst = open_multi_system(hcst_sources, ['tprate'], season_months, kind='hindcast',
+                         max_workers=config['decode_workers'])
+
+# STEP3. Units and NDJFM mean of the hindcast (lazy, computed block by block in STEP4)
+winter_hcst = convert_units(hcst.astype(COMPACT_DTYPE))['tprate'].mean(dim='forecastMonth')
+
+for forecast_year in years:
+    print(f"Forecast year: {forecast_year}")
+    fcst_sources = {name: '{foredir}/{origin}_s{system}_stmonth{start_month:02d}_forecast{year}_monthly.grib'.format(
+                        foredir=FOREDIR, year=forecast_year, **SYSTEMS[name], **config)
+                    for name in systems}
+    fcst = open_multi_system(fcst_sources, ['tprate'], season_months, kind='forecast',
+                             start_date=f"{forecast_year}-{startmonth:02d}-01")
+
+    ####################################################################
+    # STEP3. Make some computations in the data
+    winter_fcst = convert_units(fcst.astype(COMPACT_DTYPE))['tprate'].mean(dim='forecastMonth')
+
+    ####################################################################
+    # STEP4. Compute Precipitation Anomalies of all the systems at once, plus the MME
+    with parallel_decoding(config['decode_workers']):
+        system_results = multi_system_anomalies(winter_hcst, winter_fcst, basin_points, config['memory_budget'])
+
+    for system, basin_results in system_results.items():
+        # Vertientes and the whole country, rolled up from the basin partial sums
+        group_results = aggregate_hierarchy(basin_results, basin_tree())
+        areas = [(i, points['name'], basin_results[i]) for i, points in basin_points.items()]
+        areas += [(node_key(name), name, results) for name, results in group_results.items()]
+        confidence_intervals = bootstrap_confidence_intervals({i: results for i, _, results in areas},
+                                                              n_replicates=2000, confidence=0.90, seed=0)
+        model = "Multi-model ensemble" if system == MME else system
+
+        for i, name, anomalies in areas:
+            ####################################################################
+            # STEP5. Compute and Save Statistics
+            hindcast_stats = anomaly_stats(anomalies['hindcast_anomaly_basinmean'], anomalies['hcst_mean'], anomalies['hcst_std'])
+            forecast_stats = anomaly_stats(anomalies['forecast_anomaly_basinmean'], anomalies['fcst_mean'], anomalies['fcst_std'])
+            stats_df = pd.DataFrame({
+                f"Reference 1993-2016": hindcast_stats,
+                f"Forecast {forecast_year}/{forecast_year + 1}": forecast_stats}).round(2)
+            output_csv = f'{output_results}HindcastForecast_stats_basin_{i}_{system}_stmonth_{startmonth}_NDJFM_{forecast_year}.csv'
+            stats_df.to_csv(output_csv, index_label="Statistic")
+
+            ci_df = pd.DataFrame({f"{sample_set} {bound}": {stat: interval[n] for stat, interval in cis.items()}
+                                  for sample_set, cis in confidence_intervals[i].items()
+                                  for n, bound in enumerate(['low', 'high'])}).round(2)
+            ci_df.to_csv(output_csv.replace('_stats_', '_stats_ci90_'), index_label="Statistic")
+
+            ####################################################################
+            # STEP6. Report page of the system, area and year
+            report.add(f"Basin: {name}\nModel: {model}\nStartmonth: {startmonth} Period: Extended Winter (NDJFM) {forecast_year}/{forecast_year + 1}",
+                       {f"Reference\n1993-2016": anomalies['hindcast_anomaly_basinmean'],
+                        f"Forecast\n{forecast_year}/{forecast_year + 1}": anomalies['forecast_anomaly_basinmean']},
+                       stats_df, ci_df)
+        print(f"Statistics of {model} saved at {output_results}")
+
+report.write(f'{output_results}HindcastForecast_report_multisystem_stmonth_{startmonth}_NDJFM', config['report_formats'])
@@ -0,0 +1,207 @@
+"""
+Relative precipitation anomalies of the basin grid points.
+
+The anomalies are computed in a compact dtype (float32 by default) and in
+place: the hindcast and forecast arrays are overwritten by their anomalies
+instead of materialising normalised and relative copies of them. Only the
+reductions (means, standard deviations) are accumulated in float64, so the
+statistics stay numerically stable.
+
+blocked_basin_anomalies gives the same results for all the basins at once
+without loading the whole hindcast: members and start dates are processed in
+blocks sized to a memory budget and reduced with combinable partial results.
+"""
+
+import numpy as np
+import xarray as xr
+
+from blocking import sample_blocks
+from climatology import MomentAccumulator
+
+# dtype of the data arrays in the compact pipeline
+COMPACT_DTYPE = np.float32
+
+
+def point_moments(values, block=4096):
+    """
+    Mean and variance of every point, accumulated in float64 by blocks of
+    points so that no full-size float64 temporary is created.
+    :values: array (points, samples)
+    :return: mean and variance arrays of shape (points, 1)
+    """
+    mean = np.empty((values.shape[0], 1), dtype=np.float64)
+    var = np.empty((values.shape[0], 1), dtype=np.float64)
+    for start in range(0, values.shape[0], block):
+        rows = values[start:start + block].astype(np.float64)
+        mean[start:start + block] = rows.mean(axis=1, keepdims=True)
+        var[start:start + block] = rows.var(axis=1, keepdims=True)
+    return mean, var
+
+
+def basin_anomalies(hcst_values, fcst_values, dtype=COMPACT_DTYPE, inplace=False):
+    """
+    Relative anomalies of the hindcast and forecast values of one basin.
+    :hcst_values: array (points in basin, hindcast samples)
+    :fcst_values: array (points in basin, forecast members)
+    :dtype: dtype of the anomaly arrays
+    :inplace: overwrite the input arrays with the anomalies when they already
+              have the requested dtype
+    :return: dict with the basin-mean anomalies of every sample and the basin
+             precipitation mean and std of the hindcast and forecast
+    """
+    hcst = np.asarray(hcst_values)
+    fcst = np.asarray(fcst_values)
+    hcst = hcst if inplace and hcst.dtype == dtype else hcst.astype(dtype)
+    fcst = fcst if inplace and fcst.dtype == dtype else fcst.astype(dtype)
+
+    # Reductions in float64
+    hindcast_mean, hindcast_var = point_moments(hcst)  # Shape: (points in basin, 1)
+    forecast_mean, forecast_var = point_moments(fcst)
+    result = {
+        'hcst_mean': hindcast_mean.mean(),
+        'hcst_std': np.sqrt((hindcast_var + (hindcast_mean - hindcast_mean.mean()) ** 2).mean()),
+        'fcst_mean': forecast_mean.mean(),
+        'fcst_std': np.sqrt((forecast_var + (forecast_mean - forecast_mean.mean()) ** 2).mean()),
+    }
+
+    # Relative anomaly (x - mean) / mean * 100, in place
+    offset = hindcast_mean.astype(dtype)
+    scale = (100 / hindcast_mean).astype(dtype)
+    for values in (hcst, fcst):
+        np.subtract(values, offset, out=values)
+        np.multiply(values, scale, out=values)
+
+    # Mean over the basin points
+    result['hindcast_anomaly'] = hcst
+    result['forecast_anomaly'] = fcst
+    result['hindcast_anomaly_basinmean'] = hcst.mean(axis=0, dtype=np.float64)
+    result['forecast_anomaly_basinmean'] = fcst.mean(axis=0, dtype=np.float64)
+    return result
+
+
+def ensemble_mean_anomaly(hcst_mean, winter_fcst, fcst_dim='number'):
+    """
+    Relative anomaly (%) of the forecast ensemble mean at every grid cell.
+    Only the forecast is reduced (chunk by chunk if it is dask-backed).
+    :hcst_mean: hindcast mean of every cell (lat, lon), e.g. the grid moments
+                of climatology.Climatology
+    :winter_fcst: xr.DataArray (number, lat, lon)
+    :return: xr.DataArray (lat, lon)
+    """
+    fcst_mean = winter_fcst.mean(dim=fcst_dim, dtype=np.float64).transpose('lat', 'lon').compute()
+    return (fcst_mean - hcst_mean) / hcst_mean * 100
+
+
+# Percentiles of the basin-mean anomalies shown in the STEP5 table
+STEP5_PERCENTILES = {
+    "95th Percentile": 95,
+    "75th Percentile (Q3)": 75,
+    "Median (Q2)": 50,
+    "25th Percentile (Q1)": 25,
+    "5th Percentile": 5,
+}
+
+
+def anomaly_stats(anomaly_basinmean, precip_mean, precip_std):
+    """
+    Statistics of the basin-mean anomalies shown in the STEP5 table.
+    :return: dict statistic name -> value
+    """
+    stats = dict(zip(STEP5_PERCENTILES, np.percentile(anomaly_basinmean, list(STEP5_PERCENTILES.values()))))
+    stats["Basin precip mean (l/m^2)"] = precip_mean
+    stats["Basin precip std (l/m^2)"] = precip_std
+    return stats
+
+
+def blocked_basin_anomalies(winter_hcst_stacked, winter_fcst, basin_points, memory_budget,
+                            dtype=COMPACT_DTYPE, hcst_dim='new_dim', fcst_dim='number', hcst_moments=None):
+    """
+    Basin anomalies and statistics of every basin, processing the data in
+    blocks of samples that fit in memory_budget.
+    Pass 1 accumulates the hindcast moments of the basin points block by block;
+    pass 2 computes the anomalies of each block and keeps only their basin means.
+    :winter_hcst_stacked: xr.DataArray (new_dim, lat, lon), new_dim = (number, start_date)
+    :winter_fcst: xr.DataArray (number, lat, lon)
+    :basin_points: dict returned by basins.load_basin_points
+    :memory_budget: bytes (int) or string such as '4GB'
+    :hcst_moments: MomentAccumulator of the hindcast over the whole grid (e.g.
+                   climatology.Climatology.grid_moments); pass 1 is then skipped
+    :return: dict basin_id -> same statistics as basin_anomalies (without the
+             per-point anomaly arrays), the number of points of the basin and the
+             basin means of the precipitation and of its square of every sample
+             (hcst_basinmean, hcst_sq_basinmean, fcst_basinmean, fcst_sq_basinmean)
+    Other dimensions of the data (e.g. system, see multi_system.py) are batch
+    dimensions: all of them are computed together, NaN samples (padded members)
+    are skipped, and the statistics get the batch dimensions after the samples.
+    """
+    batch_dims = [d for d in winter_hcst_stacked.dims if d not in (hcst_dim, 'lat', 'lon')]
+    batch_shape = tuple(winter_hcst_stacked.sizes[d] for d in batch_dims)
+    skipna = bool(batch_dims)
+
+    # Union of the grid points of all the basins and the position of each basin in it
+    cells = np.concatenate([np.stack([p['lat_idx'], p['lon_idx']], axis=1) for p in basin_points.values()])
+    cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    bounds = np.cumsum([0] + [len(p['lat_idx']) for p in basin_points.values()])
+    members = {i: inverse[bounds[n]:bounds[n + 1]] for n, i in enumerate(basin_points)}
+    lat_idx = xr.DataArray(cells[:, 0], dims='point')
+    lon_idx = xr.DataArray(cells[:, 1], dims='point')
+
+    # Pass 1: hindcast moments of the points
+    if hcst_moments is None:
+        print("Pass 1: hindcast moments")
+        hcst_moments = MomentAccumulator(batch_shape + (len(cells),))
+        for values in sample_blocks(winter_hcst_stacked, hcst_dim, lat_idx, lon_idx, memory_budget, dtype):
+            hcst_moments.update(values, skipna=skipna)
+    else:
+        print("Pass 1: hindcast moments from the climatology")
+        grid_moments = hcst_moments
+        hcst_moments = MomentAccumulator(batch_shape + (len(cells),))
+        hcst_moments.mean = grid_moments.mean[..., cells[:, 0], cells[:, 1]]
+        hcst_moments.m2 = grid_moments.m2[..., cells[:, 0], cells[:, 1]]
+        hcst_moments.count = grid_moments.count if np.ndim(grid_moments.count) == 0 \
+            else grid_moments.count[..., cells[:, 0], cells[:, 1]]
+    offset = hcst_moments.mean.astype(dtype)
+    scale = (100 / hcst_moments.mean).astype(dtype)
+
+    # Pass 2: anomalies block by block, reduced to basin means
+    print("Pass 2: anomalies")
+    basin_anomaly = {'hcst': {i: [] for i in basin_points}, 'fcst': {i: [] for i in basin_points}}
+    # Basin means of the precipitation and of its square for every sample (for resampling)
+    basin_precip = {key: {i: [] for i in basin_points} for key in ['hcst', 'hcst_sq', 'fcst', 'fcst_sq']}
+    fcst_moments = MomentAccumulator(batch_shape + (len(cells),))
+    for name, data, dim in [('hcst', winter_hcst_stacked, hcst_dim), ('fcst', winter_fcst, fcst_dim)]:
+        for values in sample_blocks(data, dim, lat_idx, lon_idx, memory_budget, dtype):
+            if name == 'fcst':
+                fcst_moments.update(values, skipna=skipna)
+            for i, idx in members.items():
+                points = values[..., idx]
+                basin_precip[name][i].append(points.mean(axis=-1, dtype=np.float64))
+                basin_precip[name + '_sq'][i].append(np.einsum('...j,...j->...', points, points, dtype=np.float64) / len(idx))
+            np.subtract(values, offset, out=values)
+            np.multiply(values, scale, out=values)
+            for i, idx in members.items():
+                basin_anomaly[name][i].append(values[..., idx].mean(axis=-1, dtype=np.float64))
+
+    def basin_mean_std(moments, idx):
+        point_mean = moments.mean[..., idx]
+        point_var = moments.variance()[..., idx]
+        basin_mean = point_mean.mean(axis=-1, keepdims=True)
+        return basin_mean[..., 0], np.sqrt((point_var + (point_mean - basin_mean) ** 2).mean(axis=-1))
+
+    results = {}
+    for i, idx in members.items():
+        hcst_mean, hcst_std = basin_mean_std(hcst_moments, idx)
+        fcst_mean, fcst_std = basin_mean_std(fcst_moments, idx)
+        results[i] = {
+            'n_points': len(idx),
+            'hcst_mean': hcst_mean,
+            'hcst_std': hcst_std,
+            'fcst_mean': fcst_mean,
+            'fcst_std': fcst_std,
+            'hindcast_anomaly_basinmean': np.concatenate(basin_anomaly['hcst'][i]),
+            'forecast_anomaly_basinmean': np.concatenate(basin_anomaly['fcst'][i]),
+        }
+        for key, pieces in basin_precip.items():
+            results[i][f'{key}_basinmean'] = np.concatenate(pieces[i])
+    return results
@@ -0,0 +1,50 @@
+"""
+Grid points of the Spanish river basin districts.
+
+The grid_points_within_{i}.csv files written by plot_basins.py and
+subplot_basins.py list, for every basin, the grid points that fall inside it:
+x_grid is the latitude index and y_grid the longitude index of the point.
+These helpers load them once as index arrays so that basin means can be taken
+on whole arrays instead of point by point.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+def load_basin_points(path_to_csv_files, basin_ids=range(1, 26), pattern="grid_points_within_{}.csv"):
+    """
+    Load the grid points of every basin.
+    :path_to_csv_files: directory with the grid_points_within_* files
+    :basin_ids: identifiers used in the file names
+    :pattern: file name pattern, formatted with the basin identifier
+    :return: dict basin_id -> {'name', 'lat_idx', 'lon_idx'}
+    """
+    points = {}
+    for i in basin_ids:
+        file_path = os.path.join(path_to_csv_files, pattern.format(i))
+        df = pd.read_csv(file_path)
+        if 'x_grid' not in df.columns or 'y_grid' not in df.columns:
+            raise ValueError(f"{file_path} has no x_grid/y_grid columns")
+        points[i] = {
+            'name': df['basin_name'][0] if 'basin_name' in df.columns else f"Basin_{i}",
+            'lat_idx': df['x_grid'].to_numpy(dtype=np.intp),
+            'lon_idx': df['y_grid'].to_numpy(dtype=np.intp),
+        }
+    return points
+
+
+def basin_means(field, basin_points, dtype=np.float64):
+    """
+    Mean of a field over the grid points of every basin.
+    :field: array of shape (..., lat, lon)
+    :basin_points: dict returned by load_basin_points
+    :dtype: accumulation dtype
+    :return: array of shape (..., n_basins), basins in the order of basin_points
+    """
+    field = np.asarray(field)
+    means = [field[..., p['lat_idx'], p['lon_idx']].mean(axis=-1, dtype=dtype)
+             for p in basin_points.values()]
+    return np.stack(means, axis=-1)
+
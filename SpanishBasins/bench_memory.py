@@ -0,0 +1,101 @@
+"""
+Memory report of the basin anomaly computation on synthetic data.
+
+Compares the original float64 path of BoxPlot_HindcastForecast.py (STEP4),
+which materialises normalised and relative anomaly copies of the data, with the
+compact float32 in-place path of anomalies.py. Each path runs in a fresh
+process so that its peak RSS can be measured on its own.
+
+Usage: python bench_memory.py [n_points] [n_hindcast_samples] [n_forecast_members]
+       (default: a 0.25º Iberian domain, 600 hindcast samples, 51 members)
+"""
+
+import sys
+import resource
+import tracemalloc
+import multiprocessing as mp
+import numpy as np
+
+from anomalies import basin_anomalies, anomaly_stats
+
+
+def synthetic_values(n_points, n_samples, dtype, seed):
+    """Gamma distributed precipitation (l/m^2) generated directly in dtype."""
+    rng = np.random.default_rng(seed)
+    values = rng.standard_gamma(2.0, size=(n_points, n_samples), dtype=dtype)
+    values *= 40
+    return values
+
+
+def legacy_path(hcst_values, fcst_values):
+    """STEP4 and STEP5 reductions as originally written in BoxPlot_HindcastForecast.py."""
+    hindcast_mean = hcst_values.mean(axis=1, keepdims=True)
+    hindcast_std = hcst_values.std(axis=1, keepdims=True)
+    forecast_mean = fcst_values.mean(axis=1, keepdims=True)
+    forecast_std = fcst_values.std(axis=1, keepdims=True)
+    hcst_norm = (hcst_values - hindcast_mean) / hindcast_std
+    fcst_norm = (fcst_values - forecast_mean) / forecast_std
+    hindcast_anomaly = (hcst_values - hindcast_mean) / hindcast_mean * 100
+    forecast_anomaly = (fcst_values - hindcast_mean) / hindcast_mean * 100
+    hindcast_stats = anomaly_stats(hindcast_anomaly.mean(axis=0), hcst_values.mean(), hcst_values.std())
+    forecast_stats = anomaly_stats(forecast_anomaly.mean(axis=0), fcst_values.mean(), fcst_values.std())
+    return hindcast_stats, forecast_stats
+
+
+def compact_path(hcst_values, fcst_values):
+    """float32 in-place path of anomalies.py."""
+    anomalies = basin_anomalies(hcst_values, fcst_values, dtype=np.float32, inplace=True)
+    hindcast_stats = anomaly_stats(anomalies['hindcast_anomaly_basinmean'], anomalies['hcst_mean'], anomalies['hcst_std'])
+    forecast_stats = anomaly_stats(anomalies['forecast_anomaly_basinmean'], anomalies['fcst_mean'], anomalies['fcst_std'])
+    return hindcast_stats, forecast_stats
+
+
+def run(path_name, n_points, n_hcst, n_fcst, queue):
+    """Run one path and report its peak memory (executed in a child process)."""
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    if path_name == 'float64 (current)':
+        hcst_values = synthetic_values(n_points, n_hcst, np.float64, seed=1)
+        fcst_values = synthetic_values(n_points, n_fcst, np.float64, seed=2)
+        legacy_path(hcst_values, fcst_values)
+    else:
+        hcst_values = synthetic_values(n_points, n_hcst, np.float32, seed=1)
+        fcst_values = synthetic_values(n_points, n_fcst, np.float32, seed=2)
+        compact_path(hcst_values, fcst_values)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in kilobytes on Linux
+    queue.put((path_name, (rss_peak - rss_start) / 1024, traced_peak / 1024 ** 2))
+
+
+def accuracy(n_points=2000, n_hcst=600, n_fcst=51):
+    """Largest difference between the statistics of both paths on the same data."""
+    hcst_values = synthetic_values(n_points, n_hcst, np.float64, seed=1)
+    fcst_values = synthetic_values(n_points, n_fcst, np.float64, seed=2)
+    reference = legacy_path(hcst_values, fcst_values)
+    compact = compact_path(hcst_values, fcst_values)
+    return max(abs(reference[k][stat] - compact[k][stat]) for k in range(2) for stat in reference[k])
+
+
+if __name__ == '__main__':
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 184 * 364
+    n_hcst = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+    n_fcst = int(sys.argv[3]) if len(sys.argv) > 3 else 51
+    print(f"Synthetic benchmark: {n_points} points, {n_hcst} hindcast samples, {n_fcst} forecast members")
+
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    report = []
+    for path_name in ['float64 (current)', 'float32 in place']:
+        proc = ctx.Process(target=run, args=(path_name, n_points, n_hcst, n_fcst, queue))
+        proc.start()
+        report.append(queue.get())
+        proc.join()
+
+    print(f"{'Path':<20}{'Peak RSS (MB)':>16}{'Peak traced (MB)':>20}")
+    for path_name, rss_mb, traced_mb in report:
+        print(f"{path_name:<20}{rss_mb:>16.1f}{traced_mb:>20.1f}")
+    saving = 1 - report[1][1] / report[0][1]
+    print(f"Peak RSS saving: {saving:.0%}")
+    print(f"Largest difference in the statistics: {accuracy():.2e}")
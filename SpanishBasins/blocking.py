@@ -0,0 +1,56 @@
+"""
+Memory budgets for processing ensemble members and start dates in blocks,
+shared by the anomaly, climatology and SPI stages.
+"""
+
+import numpy as np
+
+# Full-size working arrays per sample of a block (data, float64 deviations, anomaly)
+WORKING_COPIES = 3
+
+
+def parse_memory(value):
+    """
+    Memory budget in bytes from an int or a string such as '512MB' or '4GB'.
+    """
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    units = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4, 'B': 1}
+    value = value.strip().upper()
+    for unit, factor in units.items():
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * factor)
+    return int(value)
+
+
+def block_size(n_items, bytes_per_item, memory_budget):
+    """
+    Number of items (samples) per block so that a block fits in the budget.
+    :n_items: total number of items
+    :bytes_per_item: size of one item in memory
+    :memory_budget: bytes (int) or string such as '4GB'
+    """
+    budget = parse_memory(memory_budget)
+    size = budget // (bytes_per_item * WORKING_COPIES)
+    if size < 1:
+        raise ValueError(f"A memory budget of {budget} bytes cannot hold a single sample "
+                         f"({bytes_per_item * WORKING_COPIES} bytes)")
+    return int(min(n_items, size))
+
+
+def sample_blocks(data, sample_dim, lat_idx, lon_idx, memory_budget, dtype):
+    """
+    Yield the values of data (sample_dim, lat, lon) at the given points, in
+    blocks of samples fitting the budget. The blocks are sized for full grids
+    since the underlying dask chunks span the whole lat/lon domain.
+    """
+    n_samples = data.sizes[sample_dim]
+    # Batch dimensions (e.g. system) are kept between the samples and the points
+    batch_dims = [d for d in data.dims if d not in (sample_dim, 'lat', 'lon')]
+    cells_per_sample = int(np.prod([data.sizes[d] for d in data.dims if d != sample_dim]))
+    size = block_size(n_samples, cells_per_sample * np.dtype(np.float64).itemsize, memory_budget)
+    n_blocks = -(-n_samples // size)
+    for b, start in enumerate(range(0, n_samples, size)):
+        print(f" - Block {b + 1}/{n_blocks}: samples {start}-{min(start + size, n_samples) - 1}")
+        block = data.isel({sample_dim: slice(start, start + size), 'lat': lat_idx, 'lon': lon_idx})
+        yield np.asarray(block.transpose(sample_dim, *batch_dims, 'point').values, dtype=dtype)
@@ -0,0 +1,102 @@
+"""
+Bootstrap confidence intervals of the STEP5 statistics.
+
+The hindcast (members x start dates, e.g. 600 samples) and the forecast (51
+members) are resampled for all the basins at once: every replicate is a row of
+an index array drawn with a seeded RNG, the basin series are gathered with it
+and the percentiles of all the basins and replicates are taken in one call.
+Three sample sets are resampled:
+
+    hindcast          bootstrap of the hindcast samples (same size as the hindcast)
+    hindcast_matched  subsamples of the hindcast without replacement with the
+                      size of the forecast ensemble, to compare like with like
+    forecast          bootstrap of the forecast members
+
+The precipitation mean and std are resampled from the basin means of the
+precipitation and of its square of every sample, so they match the
+points x samples statistics of the table.
+"""
+
+import numpy as np
+
+from anomalies import STEP5_PERCENTILES
+
+SAMPLE_SETS = ['hindcast', 'hindcast_matched', 'forecast']
+STAT_NAMES = list(STEP5_PERCENTILES) + ["Basin precip mean (l/m^2)", "Basin precip std (l/m^2)"]
+
+
+def bootstrap_indices(rng, n_samples, n_replicates, size=None, replace=True):
+    """
+    Sample indices of every replicate.
+    :size: samples per replicate (n_samples by default)
+    :replace: False for subsamples without replacement (size <= n_samples)
+    :return: int array (n_replicates, size)
+    """
+    size = n_samples if size is None else size
+    if replace:
+        return rng.integers(0, n_samples, size=(n_replicates, size))
+    if size > n_samples:
+        raise ValueError(f"Cannot draw {size} of {n_samples} samples without replacement")
+    # First `size` positions of an independent random permutation per replicate
+    return np.argsort(rng.random((n_replicates, n_samples)), axis=1)[:, :size]
+
+
+def replicate_stats(anomaly, precip, precip_sq, indices, block=250):
+    """
+    STEP5 statistics of every basin and replicate.
+    :anomaly: basin-mean anomalies, array (basins, samples)
+    :precip, precip_sq: basin means of the precipitation and of its square,
+                        arrays (basins, samples), or None
+    :indices: array (replicates, size) returned by bootstrap_indices
+    :block: replicates gathered at once (bounds the memory of the gathered copy)
+    :return: array (statistics, basins, replicates), statistics as in STAT_NAMES
+    """
+    n_basins, n_replicates = anomaly.shape[0], indices.shape[0]
+    stats = np.full((len(STAT_NAMES), n_basins, n_replicates), np.nan)
+    q = list(STEP5_PERCENTILES.values())
+    for start in range(0, n_replicates, block):
+        idx = indices[start:start + block]
+        stop = start + len(idx)
+        stats[:len(q), :, start:stop] = np.percentile(anomaly[:, idx], q, axis=-1)
+        if precip is not None:
+            mean = precip[:, idx].mean(axis=-1)
+            stats[len(q), :, start:stop] = mean
+            stats[len(q) + 1, :, start:stop] = np.sqrt(np.maximum(precip_sq[:, idx].mean(axis=-1) - mean ** 2, 0))
+    return stats
+
+
+def bootstrap_confidence_intervals(results, n_replicates=2000, confidence=0.90, seed=0, block=250):
+    """
+    Confidence intervals of the STEP5 statistics of every basin (or node).
+    :results: dict key -> dict returned by anomalies.blocked_basin_anomalies
+              or hierarchy.aggregate_hierarchy
+    :n_replicates: bootstrap replicates of every sample set
+    :confidence: coverage of the percentile intervals
+    :seed: seed of the RNG (same seed, same intervals)
+    :return: dict key -> {sample set -> {statistic -> (lower, upper)}}
+    """
+    keys = list(results)
+    rng = np.random.default_rng(seed)
+    tails = [50 * (1 - confidence), 100 - 50 * (1 - confidence)]
+
+    def stack(name):
+        if any(name not in results[k] for k in keys):
+            return None
+        return np.stack([np.asarray(results[k][name], dtype=np.float64) for k in keys])
+
+    hcst = [stack('hindcast_anomaly_basinmean'), stack('hcst_basinmean'), stack('hcst_sq_basinmean')]
+    fcst = [stack('forecast_anomaly_basinmean'), stack('fcst_basinmean'), stack('fcst_sq_basinmean')]
+    n_hcst, n_fcst = hcst[0].shape[1], fcst[0].shape[1]
+
+    intervals = {}
+    for sample_set, arrays, indices in [
+            ('hindcast', hcst, bootstrap_indices(rng, n_hcst, n_replicates)),
+            ('hindcast_matched', hcst, bootstrap_indices(rng, n_hcst, n_replicates, size=n_fcst, replace=False)),
+            ('forecast', fcst, bootstrap_indices(rng, n_fcst, n_replicates))]:
+        stats = replicate_stats(*arrays, indices, block=block)
+        intervals[sample_set] = np.percentile(stats, tails, axis=-1)  # (2, statistics, basins)
+
+    return {k: {sample_set: {name: (float(intervals[sample_set][0, s, b]), float(intervals[sample_set][1, s, b]))
+                             for s, name in enumerate(STAT_NAMES)}
+                for sample_set in SAMPLE_SETS}
+            for b, k in enumerate(keys)}
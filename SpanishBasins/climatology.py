@@ -0,0 +1,298 @@
+"""
+Incremental hindcast climatology.
+
+Instead of recomputing every statistic from the whole hindcast GRIB, the
+climatology keeps running moment accumulators (count, mean, M2) and mergeable
+quantile sketches for every grid cell and every basin. Appending a new start
+year or new ensemble members, or merging climatologies built on different
+machines, is then an update proportional to the new data only.
+
+Typical use:
+    clim = Climatology.from_hindcast(winter_hcst, basin_points)
+    clim.save(clim_dir)
+    ...
+    clim = Climatology.load(clim_dir)
+    clim.update_from_hindcast(winter_hcst)  # only the start dates and members not recorded yet
+    clim.save(clim_dir)
+
+BoxPlot_HindcastForecast.py keeps the climatology of every start month in
+products.climatology_dir and takes the hindcast moments of the anomalies
+from it.
+"""
+
+import os
+import json
+import numpy as np
+
+from basins import basin_means
+from blocking import block_size
+from products import atomic_write, write_json
+from quantile_sketch import GridQuantileSketch
+
+
+def start_date_labels(start_dates):
+    """Labels of the start dates of a hindcast (YYYY-MM-DD)."""
+    return [str(label) for label in np.datetime_as_string(np.atleast_1d(start_dates), unit='D')]
+
+
+class MomentAccumulator:
+    """Running count, mean and sum of squared deviations (M2) of every cell."""
+
+    def __init__(self, shape):
+        self.shape = tuple(int(n) for n in np.atleast_1d(shape))
+        self.count = 0
+        self.mean = np.zeros(self.shape, dtype=np.float64)
+        self.m2 = np.zeros(self.shape, dtype=np.float64)
+
+    def _combine(self, count, mean, m2):
+        """
+        Chan et al. parallel update with the moments of another sample set.
+        The counts are arrays of the cell shape when NaN samples are skipped.
+        """
+        if np.all(count == 0):
+            return self
+        total = self.count + count
+        if np.ndim(total) > 0:
+            # Cells without new samples keep their moments
+            with np.errstate(invalid='ignore', divide='ignore'):
+                delta = np.where(count > 0, mean - self.mean, 0)
+                self.mean = self.mean + delta * np.where(total > 0, count / total, 0)
+                self.m2 = self.m2 + np.where(count > 0, m2, 0) + delta ** 2 * np.where(total > 0, self.count * count / total, 0)
+            self.count = total
+            return self
+        delta = mean - self.mean
+        self.mean += delta * (count / total)
+        self.m2 += m2 + delta ** 2 * (self.count * count / total)
+        self.count = total
+        return self
+
+    def update(self, samples, skipna=False):
+        """
+        Add a block of samples.
+        :samples: array of shape (n_samples, *shape)
+        :skipna: ignore NaN samples (e.g. members padded to a common ensemble
+                 size); the count becomes an array of the cell shape
+        """
+        samples = np.asarray(samples)
+        if skipna:
+            # One sample at a time, so the temporaries have the size of one sample
+            # and the block stays within the working copies of blocking.WORKING_COPIES
+            count = np.zeros(samples.shape[1:], dtype=np.int64)
+            mean = np.zeros(samples.shape[1:], dtype=np.float64)
+            m2 = np.zeros(samples.shape[1:], dtype=np.float64)
+            deviation = np.empty(samples.shape[1:], dtype=np.float64)
+            for sample in samples:
+                valid = ~np.isnan(sample)
+                count += valid
+                np.add(mean, sample, out=mean, where=valid)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean /= count
+            for sample in samples:
+                np.subtract(sample, mean, out=deviation)
+                np.nan_to_num(deviation, copy=False)
+                m2 += deviation * deviation
+            return self._combine(count, mean, m2)
+        mean = samples.mean(axis=0, dtype=np.float64)
+        m2 = ((samples - mean) ** 2).sum(axis=0, dtype=np.float64)
+        return self._combine(samples.shape[0], mean, m2)
+
+    def merge(self, other):
+        """Merge the moments of another accumulator of the same shape."""
+        if other.shape != self.shape:
+            raise ValueError(f"Cannot merge accumulators of shapes {self.shape} and {other.shape}")
+        return self._combine(other.count, other.mean, other.m2)
+
+    def variance(self, ddof=0):
+        """Variance of every cell (ddof=0 as np.std/np.var)."""
+        return self.m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        """Standard deviation of every cell."""
+        return np.sqrt(self.variance(ddof))
+
+
+class Climatology:
+    """Moments and quantile sketches of the hindcast for grid cells and basins."""
+
+    def __init__(self, grid_shape, basin_points=None, k=200, seed=None, source=None):
+        """
+        :grid_shape: (lat, lon) shape of the grid
+        :basin_points: dict returned by basins.load_basin_points, or None
+        :k: accuracy parameter of the quantile sketches
+        :source: identifier of the data behind the samples (e.g. grid and bias
+                 correction, see products.cache_key), checked by matches
+        """
+        self.grid_shape = tuple(grid_shape)
+        self.basin_points = basin_points
+        self.source = source
+        self.labels = []
+        self.members = {}  # number of samples of every label
+        self.grid_moments = MomentAccumulator(self.grid_shape)
+        self.grid_sketch = GridQuantileSketch(self.grid_shape, k=k, seed=seed)
+        self.basin_moments = None
+        self.basin_sketch = None
+        if basin_points is not None:
+            self.basin_moments = MomentAccumulator(len(basin_points))
+            self.basin_sketch = GridQuantileSketch(len(basin_points), k=k, seed=seed)
+
+    def update(self, samples, label=None):
+        """
+        Add new hindcast samples (a new start year or new members).
+        :samples: array of shape (n_samples, lat, lon)
+        :label: identifier of the samples (e.g. the start date); a label can
+                only be added once so reruns do not count data twice
+        """
+        if label is not None:
+            if label in self.labels:
+                raise ValueError(f"Samples '{label}' are already in the climatology")
+            self.labels.append(label)
+        samples = np.asarray(samples)
+        if label is not None:
+            self.members[label] = samples.shape[0]
+        self.grid_moments.update(samples)
+        self.grid_sketch.update(samples)
+        if self.basin_points is not None:
+            basin_values = basin_means(samples, self.basin_points)
+            self.basin_moments.update(basin_values)
+            self.basin_sketch.update(basin_values)
+        return self
+
+    def merge(self, other):
+        """Merge a climatology built elsewhere on the same grid and basins."""
+        overlap = set(self.labels) & set(other.labels)
+        if overlap:
+            raise ValueError(f"Samples {sorted(overlap)} are in both climatologies")
+        self.labels.extend(other.labels)
+        self.members.update(other.members)
+        self.grid_moments.merge(other.grid_moments)
+        self.grid_sketch.merge(other.grid_sketch)
+        if self.basin_moments is not None:
+            if other.basin_moments is None:
+                raise ValueError("Cannot merge a climatology without basin statistics")
+            self.basin_moments.merge(other.basin_moments)
+            self.basin_sketch.merge(other.basin_sketch)
+        return self
+
+    def update_from_hindcast(self, winter_hcst, memory_budget=None, sample_dim='number', year_dim='start_date'):
+        """
+        Add the start dates of the hindcast that are not in the climatology yet,
+        and the members added to the start dates it already has (the recorded
+        members are the first ones of sample_dim), reading one start date at a time.
+        :winter_hcst: xr.DataArray with dimensions (number, start_date, lat, lon)
+        :memory_budget: if given (bytes or string such as '4GB'), the members of
+                        each start date are also read in blocks fitting the budget
+        :return: labels of the start dates added or with added members
+        """
+        n_members = winter_hcst.sizes[sample_dim]
+        size = n_members
+        if memory_budget is not None:
+            bytes_per_member = winter_hcst.sizes['lat'] * winter_hcst.sizes['lon'] * np.dtype(np.float64).itemsize
+            size = block_size(n_members, bytes_per_member, memory_budget)
+        labels = start_date_labels(winter_hcst[year_dim].values)
+        new = [t for t, label in enumerate(labels) if self.members.get(label, 0) < n_members]
+        for n, t in enumerate(new):
+            year = winter_hcst.isel({year_dim: t})
+            recorded = self.members.get(labels[t], 0)
+            print(f" - Adding members {recorded + 1}-{n_members} of start date {labels[t]} ({n + 1}/{len(new)})")
+            for start in range(recorded, n_members, size):
+                block = year.isel({sample_dim: slice(start, min(start + size, n_members))})
+                self.update(block.transpose(sample_dim, 'lat', 'lon').values)
+            if labels[t] not in self.labels:
+                self.labels.append(labels[t])
+            self.members[labels[t]] = n_members
+        return [labels[t] for t in new]
+
+    @classmethod
+    def from_hindcast(cls, winter_hcst, basin_points=None, k=200, seed=None, memory_budget=None,
+                      sample_dim='number', year_dim='start_date', source=None):
+        """
+        Build the climatology reading the hindcast one start date at a time.
+        :winter_hcst: xr.DataArray with dimensions (number, start_date, lat, lon)
+        :memory_budget: if given (bytes or string such as '4GB'), the members of
+                        each start date are also read in blocks fitting the budget
+        """
+        clim = cls((winter_hcst.sizes['lat'], winter_hcst.sizes['lon']), basin_points, k=k, seed=seed, source=source)
+        clim.update_from_hindcast(winter_hcst, memory_budget, sample_dim, year_dim)
+        return clim
+
+    def matches(self, winter_hcst, basin_points=None, source=None, sample_dim='number', year_dim='start_date'):
+        """
+        True if the climatology can be updated with winter_hcst: same source,
+        grid and basins, and all its start dates and members are still in the
+        hindcast (replaced or removed samples cannot be taken out of the moments
+        and sketches).
+        """
+        if self.source != source:
+            return False
+        if self.grid_shape != (winter_hcst.sizes['lat'], winter_hcst.sizes['lon']):
+            return False
+        if set(self.labels) != set(self.members):
+            return False  # member counts not recorded
+        if not set(self.labels) <= set(start_date_labels(winter_hcst[year_dim].values)):
+            return False
+        if any(n > winter_hcst.sizes[sample_dim] for n in self.members.values()):
+            return False
+        if basin_points is None or self.basin_points is None:
+            return basin_points is None and self.basin_points is None
+        return list(basin_points) == list(self.basin_points) and all(
+            np.array_equal(p['lat_idx'], self.basin_points[i]['lat_idx'])
+            and np.array_equal(p['lon_idx'], self.basin_points[i]['lon_idx'])
+            for i, p in basin_points.items())
+
+    # --------------------------------------------------------------
+    # Persistence
+    def save(self, path):
+        """Save the climatology to a directory."""
+        os.makedirs(path, exist_ok=True)
+        moments = {'grid_count': self.grid_moments.count,
+                   'grid_mean': self.grid_moments.mean,
+                   'grid_m2': self.grid_moments.m2}
+        atomic_write(os.path.join(path, 'grid_sketch.npz'), self.grid_sketch.save)
+        if self.basin_points is not None:
+            moments.update(basin_count=self.basin_moments.count,
+                           basin_mean=self.basin_moments.mean,
+                           basin_m2=self.basin_moments.m2)
+            atomic_write(os.path.join(path, 'basin_sketch.npz'), self.basin_sketch.save)
+        atomic_write(os.path.join(path, 'moments.npz'), lambda tmp: np.savez(tmp, **moments))
+        meta = {'grid_shape': list(self.grid_shape), 'labels': self.labels, 'members': self.members,
+                'source': self.source}
+        if self.basin_points is not None:
+            meta['basins'] = {str(i): {'name': str(p['name']),
+                                       'lat_idx': p['lat_idx'].tolist(),
+                                       'lon_idx': p['lon_idx'].tolist()}
+                              for i, p in self.basin_points.items()}
+        write_json(os.path.join(path, 'climatology.json'), meta)  # written last (query_service.py cache key)
+        print(f"Climatology saved at {path}")
+
+    @staticmethod
+    def _count(value):
+        """Count saved by save: an int, or an array of counts (NaN samples skipped)."""
+        value = np.asarray(value)
+        return int(value) if value.ndim == 0 else value
+
+    @classmethod
+    def load(cls, path, seed=None):
+        """Load a climatology saved with Climatology.save."""
+        with open(os.path.join(path, 'climatology.json')) as f:
+            meta = json.load(f)
+        basin_points = None
+        if 'basins' in meta:
+            basin_points = {int(i): {'name': p['name'],
+                                     'lat_idx': np.array(p['lat_idx'], dtype=np.intp),
+                                     'lon_idx': np.array(p['lon_idx'], dtype=np.intp)}
+                            for i, p in meta['basins'].items()}
+        clim = cls(meta['grid_shape'], basin_points, seed=seed, source=meta.get('source'))
+        clim.labels = meta['labels']
+        clim.members = meta.get('members', {})
+        clim.grid_sketch = GridQuantileSketch.load(os.path.join(path, 'grid_sketch.npz'), seed=seed)
+        with np.load(os.path.join(path, 'moments.npz')) as moments:
+            clim.grid_moments.count = cls._count(moments['grid_count'])
+            clim.grid_moments.mean = moments['grid_mean']
+            clim.grid_moments.m2 = moments['grid_m2']
+            if basin_points is not None:
+                clim.basin_moments.count = cls._count(moments['basin_count'])
+                clim.basin_moments.mean = moments['basin_mean']
+                clim.basin_moments.m2 = moments['basin_m2']
+        if basin_points is not None:
+            clim.basin_sketch = GridQuantileSketch.load(os.path.join(path, 'basin_sketch.npz'), seed=seed)
+        return clim
@@ -0,0 +1,108 @@
+"""
+Cached basin geometry store.
+
+Every script used to call gpd.read_file on the MITECO shapefile at startup and
+to draw and test containment against the full-detail coastlines. The cache
+reads the shapefile once and writes GeoParquet files with precomputed bounds
+and centroids:
+
+    {cache_dir}/basins_exact.parquet   full-detail geometries (grid point masks)
+    {cache_dir}/basins_plot.parquet    simplified for drawing maps
+
+The grid_points_within_* masks are always built from the exact geometries:
+the simplification gives no bound on how far a border moves, so the
+simplified level is only used for drawing. The simplification preserves the
+topology of the coverage (shared borders between basins stay shared) when
+shapely >= 2.1 is available. The cache is rebuilt when the shapefile is newer
+than it.
+"""
+
+import os
+from functools import lru_cache
+import numpy as np
+import shapely
+import geopandas as gpd
+
+# Simplification tolerance (degrees) of each level.
+# coverage_simplify (Visvalingam-Whyatt) uses an area-based tolerance, so a
+# border can move further than this: the levels are for drawing only, and
+# containment is tested against the exact geometries.
+TOLERANCES = {
+    'plot': 0.02,
+}
+
+
+def _cache_file(cache_dir, level):
+    return os.path.join(cache_dir, f"basins_{level}.parquet")
+
+
+def _simplify(geometries, tolerance):
+    """Topology-preserving simplification of a coverage of polygons."""
+    if hasattr(shapely, 'coverage_simplify'):
+        return shapely.coverage_simplify(geometries, tolerance, simplify_boundary=True)
+    return shapely.simplify(geometries, tolerance, preserve_topology=True)
+
+
+def build_geometry_cache(shapefile, cache_dir, tolerances=TOLERANCES):
+    """
+    Write the exact and simplified basin geometries as GeoParquet.
+    :shapefile: path of the MITECO basin shapefile
+    :cache_dir: output directory
+    :tolerances: dict level -> simplification tolerance in degrees
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    print(f"Building basin geometry cache from {shapefile}")
+    basins = gpd.read_file(shapefile)
+    # The grids are regular lat/lon, so the cache is kept in geographic coordinates
+    if basins.crs is not None and not basins.crs.is_geographic:
+        basins = basins.to_crs(epsg=4326)
+    basins.geometry = shapely.make_valid(basins.geometry.values)
+
+    levels = {'exact': basins.geometry.values}
+    for level, tolerance in tolerances.items():
+        levels[level] = _simplify(basins.geometry.values, tolerance)
+
+    for level, geometries in levels.items():
+        gdf = basins.copy()
+        gdf.geometry = geometries
+        bounds = shapely.bounds(geometries)
+        centroids = shapely.centroid(basins.geometry.values)  # centroids of the exact geometries
+        gdf['minx'], gdf['miny'], gdf['maxx'], gdf['maxy'] = bounds.T
+        gdf['centroid_x'] = shapely.get_x(centroids)
+        gdf['centroid_y'] = shapely.get_y(centroids)
+        gdf['n_vertices'] = shapely.get_num_coordinates(geometries)
+        gdf.to_parquet(_cache_file(cache_dir, level))
+        print(f" - {level}: {int(gdf['n_vertices'].sum())} vertices")
+    load_basins.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def load_basins(cache_dir, level='exact', shapefile=None):
+    """
+    Basin geometries of a level ('exact' or 'plot').
+    If shapefile is given, the cache is (re)built when missing or older than it.
+    :return: gpd.GeoDataFrame (cached in memory for the whole run)
+    """
+    path = _cache_file(cache_dir, level)
+    if shapefile is not None and (not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(shapefile)):
+        build_geometry_cache(shapefile, cache_dir)
+    return gpd.read_parquet(path)
+
+
+def basin_grid_points(geometry, lats, lons):
+    """
+    Grid points inside a basin, tested on whole arrays.
+    :geometry: shapely geometry of the basin
+    :lats, lons: 1-D coordinates of the grid
+    :return: (lat_idx, lon_idx) index arrays of the points inside the basin
+    """
+    minx, miny, maxx, maxy = geometry.bounds
+    # Only the points inside the bounding box are tested
+    lat_idx = np.where((lats >= miny) & (lats <= maxy))[0]
+    lon_idx = np.where((lons >= minx) & (lons <= maxx))[0]
+    if len(lat_idx) == 0 or len(lon_idx) == 0:
+        return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+    lat_grid, lon_grid = np.meshgrid(lat_idx, lon_idx, indexing='ij')
+    shapely.prepare(geometry)
+    inside = shapely.contains_xy(geometry, lons[lon_grid], lats[lat_grid])
+    return lat_grid[inside], lon_grid[inside]
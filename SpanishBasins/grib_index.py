@@ -0,0 +1,207 @@
+"""
+Selective GRIB decoding.
+
+cfgrib decodes every message of a GRIB file into the xr.Dataset, although the
+NDJFM computation only needs forecastMonth 1-5 or 2-6 and remapbil.py only
+tprate. build_index walks the file once reading only the message headers and
+keeps, for every message, its variable, forecastMonth, member, start date and
+byte offset. open_grib_selection then decodes only the messages a season,
+variable and region request needs.
+
+The index is cached next to the GRIB file as {grib_file}.msgidx.csv (written
+atomically, see products.atomic_write) and is rebuilt when the GRIB file is
+newer than it.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask
+import dask.array as da
+import eccodes
+from dateutil.relativedelta import relativedelta
+
+from products import atomic_write
+
+# Message keys stored in the index
+INDEX_KEYS = ['shortName', 'forecastMonth', 'number', 'dataDate', 'dataTime', 'indexingDate', 'indexingTime']
+
+# forecastMonths of the extended winter (NDJFM) for each start month
+NDJFM_MONTHS = {11: [1, 2, 3, 4, 5], 10: [2, 3, 4, 5, 6]}
+
+
+def _get(gid, key):
+    """Value of a message key, or None if the message does not have it."""
+    try:
+        return eccodes.codes_get(gid, key)
+    except eccodes.KeyValueNotFoundError:
+        return None
+
+
+def build_index(grib_file, index_file=None):
+    """
+    Index of the messages of a GRIB file (reads only the message headers).
+    :return: pd.DataFrame with one row per message: offset, length and INDEX_KEYS
+    """
+    index_file = index_file or f"{grib_file}.msgidx.csv"
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(grib_file):
+        return pd.read_csv(index_file)
+
+    print(f"Indexing GRIB messages of {grib_file}")
+    rows = []
+    with open(grib_file, 'rb') as f:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(f, headers_only=True)
+            if gid is None:
+                break
+            row = {'offset': eccodes.codes_get(gid, 'offset', ktype=int),
+                   'length': eccodes.codes_get(gid, 'totalLength')}
+            row.update({key: _get(gid, key) for key in INDEX_KEYS})
+            rows.append(row)
+            eccodes.codes_release(gid)
+    index = pd.DataFrame(rows)
+    # Renamed into place, so concurrent readers never see a truncated index
+    atomic_write(index_file, lambda tmp: index.to_csv(tmp, index=False))
+    print(f"{len(index)} messages indexed in {index_file}")
+    return index
+
+
+def start_dates(index, lagged=False):
+    """Start date of every message (indexing date for lagged ensembles)."""
+    date, time = ('indexingDate', 'indexingTime') if lagged else ('dataDate', 'dataTime')
+    return pd.to_datetime(index[date].astype(int).astype(str) + index[time].astype(int).map('{:04d}'.format),
+                          format='%Y%m%d%H%M')
+
+
+def select_messages(index, variables=None, forecast_months=None, numbers=None, dates=None, lagged=False):
+    """Rows of the index matching the requested variables, months, members and start dates."""
+    mask = np.ones(len(index), dtype=bool)
+    if variables is not None:
+        mask &= index['shortName'].isin(variables).to_numpy()
+    if forecast_months is not None:
+        mask &= index['forecastMonth'].isin(forecast_months).to_numpy()
+    if numbers is not None:
+        mask &= index['number'].isin(numbers).to_numpy()
+    selection = index[mask].copy()
+    selection['start_date'] = start_dates(selection, lagged)
+    if dates is not None:
+        selection = selection[selection['start_date'].isin(pd.to_datetime(dates))]
+    if selection.empty:
+        raise ValueError("No GRIB message matches the request")
+    return selection
+
+
+def read_message(grib_file, offset, length):
+    """Decode one message: values (lat, lon) with NaN for missing points, latitudes and longitudes."""
+    with open(grib_file, 'rb') as f:
+        f.seek(offset)
+        message = f.read(length)
+    gid = eccodes.codes_new_from_message(message)
+    try:
+        ni, nj = eccodes.codes_get(gid, 'Ni'), eccodes.codes_get(gid, 'Nj')
+        values = eccodes.codes_get_values(gid).reshape(nj, ni)
+        if eccodes.codes_get(gid, 'bitmapPresent'):
+            values = np.where(values == eccodes.codes_get(gid, 'missingValue'), np.nan, values)
+        lats = eccodes.codes_get_array(gid, 'latitudes').reshape(nj, ni)[:, 0]
+        lons = eccodes.codes_get_array(gid, 'longitudes').reshape(nj, ni)[0, :]
+    finally:
+        eccodes.codes_release(gid)
+    return values, lats, lons
+
+
+def decode_field(grib_file, offset, length, lat_sel, lon_sel, dtype=np.float32):
+    """Decode one message and keep the (lat_sel, lon_sel) part of it."""
+    values = read_message(grib_file, offset, length)[0]
+    return values[np.ix_(lat_sel, lon_sel)].astype(dtype)
+
+
+def _region_slices(lats, lons, region):
+    """Index arrays of the latitudes and longitudes inside region {'lat': (min, max), 'lon': (min, max)}."""
+    lat_sel = np.arange(len(lats))
+    lon_sel = np.arange(len(lons))
+    if region is not None:
+        if 'lat' in region:
+            lat_sel = np.where((lats >= min(region['lat'])) & (lats <= max(region['lat'])))[0]
+        if 'lon' in region:
+            lon_sel = np.where((lons >= min(region['lon'])) & (lons <= max(region['lon'])))[0]
+    return lat_sel, lon_sel
+
+
+def add_time_coords(ds):
+    """Add the start_month and valid_time coordinates built by the scripts."""
+    if 'start_date' in ds.dims:
+        start_month = pd.to_datetime(ds.start_date.values[0]).month
+        vt = xr.DataArray(dims=('start_date', 'forecastMonth'),
+                          coords={'forecastMonth': ds.forecastMonth, 'start_date': ds.start_date})
+        vt.data = [[pd.to_datetime(std) + relativedelta(months=int(fcmonth) - 1) for fcmonth in vt.forecastMonth.values]
+                   for std in vt.start_date.values]
+    else:
+        start_month = pd.to_datetime(ds.start_date.values).month
+        vt = xr.DataArray(dims=('forecastMonth',), coords={'forecastMonth': ds.forecastMonth})
+        vt.data = [pd.to_datetime(ds.start_date.values) + relativedelta(months=int(fcmonth) - 1)
+                   for fcmonth in ds.forecastMonth.values]
+    return ds.assign_coords({'start_month': start_month, 'valid_time': vt})
+
+
+def open_grib_selection(grib_file, variables, forecast_months=None, numbers=None, dates=None,
+                        region=None, lagged=False, lazy=True, dtype=np.float32, index=None):
+    """
+    Open only the GRIB messages needed by a request.
+    :variables: list of shortNames (e.g. ['tprate'])
+    :forecast_months: forecastMonths to read (e.g. NDJFM_MONTHS[start_month]), None for all
+    :numbers: ensemble members to read, None for all
+    :dates: start dates to read, None for all
+    :region: {'lat': (min, max), 'lon': (min, max)} in the GRIB coordinates, None for the whole grid
+    :lagged: use the indexing date as start date (lagged ensembles)
+    :lazy: decode the messages when the data are computed (one dask chunk per
+           message, so the messages can be decoded in parallel, see grib_parallel.py)
+    :return: xr.Dataset with dimensions (number, start_date, forecastMonth, lat, lon);
+             start_date is a scalar coordinate when a single start date is read
+    """
+    index = build_index(grib_file) if index is None else index
+    selection = select_messages(index, variables, forecast_months, numbers, dates, lagged)
+    print(f"Decoding {len(selection)} of {len(index)} GRIB messages of {os.path.basename(grib_file)}")
+
+    # Grid of the first selected message
+    first = selection.iloc[0]
+    _, lats, lons = read_message(grib_file, int(first['offset']), int(first['length']))
+    lat_sel, lon_sel = _region_slices(lats, lons, region)
+    field_shape = (len(lat_sel), len(lon_sel))
+
+    coords = {
+        'number': np.unique(selection['number'].to_numpy()),
+        'start_date': np.unique(selection['start_date'].to_numpy()),
+        'forecastMonth': np.unique(selection['forecastMonth'].to_numpy()),
+        'lat': lats[lat_sel],
+        'lon': lons[lon_sel],
+    }
+    dims = list(coords)
+    shape = tuple(len(c) for c in coords.values())
+
+    data_vars = {}
+    for var in variables:
+        rows = selection[selection['shortName'] == var]
+        if len(rows) != np.prod(shape[:3]):
+            raise ValueError(f"{var}: {len(rows)} messages found, {int(np.prod(shape[:3]))} expected "
+                             "(missing members, start dates or forecastMonths)")
+        pos = {dim: np.searchsorted(coords[dim], rows[dim].to_numpy()) for dim in dims[:3]}
+        order = np.lexsort((pos['forecastMonth'], pos['start_date'], pos['number']))
+        offsets = rows['offset'].to_numpy()[order].astype(int)
+        lengths = rows['length'].to_numpy()[order].astype(int)
+        if lazy:
+            fields = [da.from_delayed(dask.delayed(decode_field)(grib_file, o, l, lat_sel, lon_sel, dtype),
+                                      field_shape, dtype=dtype)
+                      for o, l in zip(offsets, lengths)]
+            values = da.stack(fields).reshape(shape)
+        else:
+            values = np.empty(shape, dtype=dtype)
+            flat = values.reshape((-1,) + field_shape)
+            for n, (o, l) in enumerate(zip(offsets, lengths)):
+                flat[n] = decode_field(grib_file, o, l, lat_sel, lon_sel, dtype)
+        data_vars[var] = (dims, values)
+
+    ds = xr.Dataset(data_vars, coords=coords)
+    if ds.sizes['start_date'] == 1:
+        ds = ds.squeeze('start_date')
+    return add_time_coords(ds)
@@ -0,0 +1,89 @@
+"""
+Parallel decoding of GRIB data split across files and processes.
+
+The hindcast can be given as one large GRIB file, a directory or a glob of
+per-year / per-chunk GRIB files. Every file is indexed (in parallel) with
+grib_index.build_index and opened lazily with one dask chunk per GRIB message,
+so one large file is effectively split by message offsets. The pieces are
+concatenated lazily along start_date with the start_date / forecastMonth /
+valid_time coordinates the scripts use, and the messages are decoded in a
+process pool when the data are computed inside parallel_decoding():
+
+    hcst = open_grib_parallel(HINDDIR + '/ecmwf_s51_stmonth11_hindcast*.grib', ['tprate'], [1, 2, 3, 4, 5])
+    with parallel_decoding(max_workers=16):
+        values = hcst['tprate'].values
+"""
+
+import os
+import glob
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import dask
+import xarray as xr
+
+from grib_index import build_index, open_grib_selection, add_time_coords
+
+
+def list_grib_files(source):
+    """
+    GRIB files of a source: a file, a directory (all *.grib / *.grb files),
+    a glob pattern or a list of files.
+    """
+    if isinstance(source, (list, tuple)):
+        files = list(source)
+    elif os.path.isdir(source):
+        files = glob.glob(os.path.join(source, '*.grib')) + glob.glob(os.path.join(source, '*.grb'))
+    elif os.path.isfile(source):
+        files = [source]
+    else:
+        files = glob.glob(source)
+    if not files:
+        raise FileNotFoundError(f"No GRIB files found in {source}")
+    return sorted(files)
+
+
+def open_grib_parallel(source, variables, forecast_months=None, numbers=None, dates=None,
+                       region=None, lagged=False, max_workers=None, **kwargs):
+    """
+    Open the GRIB pieces of a source as one lazily concatenated dataset.
+    :source: file, directory, glob pattern or list of files
+    :max_workers: processes used to index the files (None: one per core)
+    Other arguments as in grib_index.open_grib_selection.
+    :return: xr.Dataset (number, start_date, forecastMonth, lat, lon), dask-backed
+    """
+    files = list_grib_files(source)
+    print(f"Opening {len(files)} GRIB file(s) from {source}")
+    if len(files) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            indexes = list(pool.map(build_index, files))
+    else:
+        indexes = [build_index(files[0])]
+
+    pieces = []
+    for grib_file, index in zip(files, indexes):
+        piece = open_grib_selection(grib_file, variables, forecast_months, numbers, dates,
+                                    region=region, lagged=lagged, lazy=True, index=index, **kwargs)
+        # The time coordinates are rebuilt once on the concatenated dataset
+        piece = piece.drop_vars(['valid_time', 'start_month'])
+        if 'start_date' not in piece.dims:
+            piece = piece.expand_dims('start_date')
+        pieces.append(piece)
+
+    ds = xr.concat(pieces, dim='start_date') if len(pieces) > 1 else pieces[0]
+    ds = ds.sortby('start_date').transpose('number', 'start_date', 'forecastMonth', 'lat', 'lon')
+    if ds.indexes['start_date'].has_duplicates:
+        raise ValueError("The same start date is found in several GRIB pieces")
+    if ds.sizes['start_date'] == 1:
+        ds = ds.squeeze('start_date')
+    return add_time_coords(ds)
+
+
+@contextmanager
+def parallel_decoding(max_workers=None):
+    """
+    Decode the GRIB messages of dask-backed datasets in a pool of processes
+    while the context is active (max_workers=None: one process per core).
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        with dask.config.set(scheduler='processes', pool=pool):
+            yield pool
@@ -0,0 +1,118 @@
+"""
+Hierarchical aggregation of the basin results: basin -> vertiente -> Spain.
+
+The basin anomalies are point means, so each basin is summarised by its
+weighted sum and its weight (number of grid points, or any other point
+weights). These partial sums are rolled up through a configurable tree, so the
+ensemble distributions of every vertiente and of the whole country come from
+the basin results without a second pass over the grid.
+"""
+
+import unicodedata
+import numpy as np
+
+# Basin groups (vertientes), by shapefile row index (also used by plot_basins.py)
+GROUPS = {
+    "Vertiente Atlántico Norte y Cantábrico": [1, 3, 4, 17],
+    "Vertiente Atlántico Sur": [8, 9, 15],
+    "Vertiente Mediterránea": [0, 2, 10, 11, 12, 13, 14, 16],
+    "Cuencas Interiores": [5, 6, 7],
+    "Islas Canarias": [18, 19, 20, 21, 22, 23, 24]
+}
+
+
+def basin_tree(groups=GROUPS, id_offset=1, root="España"):
+    """
+    Aggregation tree of the basins.
+    :groups: dict group name -> shapefile row indexes of its basins
+    :id_offset: offset from the row index to the basin identifier used in the
+                grid_points_within_{i}.csv files (row + 1)
+    :root: name of the national node, None for no national node
+    :return: dict node name -> list of children (basin identifiers or node names)
+    """
+    tree = {group: [i + id_offset for i in indices] for group, indices in groups.items()}
+    if root is not None:
+        tree[root] = list(groups)
+    return tree
+
+
+def node_key(name):
+    """File-name friendly key of a node, e.g. 'Vertiente Atlántico Sur' -> 'vertiente_atlantico_sur'."""
+    ascii_name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode()
+    return '_'.join(ascii_name.lower().split())
+
+
+def _leaves(tree, node):
+    """Basin identifiers below a node of the tree."""
+    if node not in tree:
+        return [node]
+    return [leaf for child in tree[node] for leaf in _leaves(tree, child)]
+
+
+def _combine(parts):
+    """Weighted sums and weights of a node from those of its children."""
+    weight = sum(p['weight'] for p in parts)
+    total = {'weight': weight}
+    for key in parts[0]:
+        if key != 'weight':
+            total[key] = sum(p[key] for p in parts)
+    return total
+
+
+def _partial_sums(result, weight):
+    """Weighted sums of a basin result (weight = number of points by default)."""
+    sums = {
+        'weight': weight,
+        'hindcast_sum': weight * np.asarray(result['hindcast_anomaly_basinmean']),
+        'forecast_sum': weight * np.asarray(result['forecast_anomaly_basinmean']),
+        # precipitation moments over points x samples
+        'hcst_sum': weight * result['hcst_mean'],
+        'hcst_sumsq': weight * (result['hcst_std'] ** 2 + result['hcst_mean'] ** 2),
+        'fcst_sum': weight * result['fcst_mean'],
+        'fcst_sumsq': weight * (result['fcst_std'] ** 2 + result['fcst_mean'] ** 2),
+    }
+    # Basin means of every sample, when available
+    for key in ['hcst_basinmean', 'hcst_sq_basinmean', 'fcst_basinmean', 'fcst_sq_basinmean']:
+        if key in result:
+            sums[key] = weight * np.asarray(result[key])
+    return sums
+
+
+def aggregate_hierarchy(basin_results, tree=None, weights=None):
+    """
+    Results of every node of the tree from the basin results.
+    :basin_results: dict basin_id -> dict returned by anomalies.blocked_basin_anomalies
+    :tree: dict returned by basin_tree (default tree if None)
+    :weights: dict basin_id -> weight; by default the number of grid points
+    :return: dict node name -> dict with the same keys as a basin result
+    """
+    tree = basin_tree() if tree is None else tree
+    sums = {i: _partial_sums(r, r['n_points'] if weights is None else weights[i])
+            for i, r in basin_results.items()}
+
+    def node_sums(node):
+        if node not in sums:
+            missing = [leaf for leaf in _leaves(tree, node) if leaf not in tree and leaf not in basin_results]
+            if missing:
+                raise KeyError(f"Node '{node}' needs basins {missing} that are not in the results")
+            sums[node] = _combine([node_sums(child) for child in tree[node]])
+        return sums[node]
+
+    results = {}
+    for node in tree:
+        s = node_sums(node)
+        w = s['weight']
+        hcst_mean, fcst_mean = s['hcst_sum'] / w, s['fcst_sum'] / w
+        results[node] = {
+            'n_points': sum(basin_results[leaf]['n_points'] for leaf in _leaves(tree, node)),
+            'hcst_mean': hcst_mean,
+            'hcst_std': np.sqrt(max(s['hcst_sumsq'] / w - hcst_mean ** 2, 0)),
+            'fcst_mean': fcst_mean,
+            'fcst_std': np.sqrt(max(s['fcst_sumsq'] / w - fcst_mean ** 2, 0)),
+            'hindcast_anomaly_basinmean': s['hindcast_sum'] / w,
+            'forecast_anomaly_basinmean': s['forecast_sum'] / w,
+        }
+        for key in ['hcst_basinmean', 'hcst_sq_basinmean', 'fcst_basinmean', 'fcst_sq_basinmean']:
+            if key in s:
+                results[node][key] = s[key] / w
+    return results
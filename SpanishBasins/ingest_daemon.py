@@ -0,0 +1,363 @@
+"""
+Watch mode: process new forecast and hindcast GRIB files as they arrive.
+
+The input directories are polled for *.grib / *.grb files named as the CDS
+downloads ({origin}_s{system}_stmonth{MM}_forecast{YYYY}_monthly.grib or
+..._hindcast{YYYY}-{YYYY}_monthly.grib). A file is processed once it is
+complete: its size and modification time did not change between two polls and
+it ends with the GRIB end marker '7777'. Only the products that depend on it
+are run, stage by stage:
+
+    ingest     index of the GRIB messages (grib_index.build_index)
+    remap      bilinear remap to the ERA5 grid, when REMAP_OUTPUT_DIR is set
+    products   anomalies, statistics, report and maps of the start month
+               (BoxPlot_HindcastForecast.py with ORIGIN, SYSTEM, START_MONTH,
+               FORECAST_YEARS, FOREDIR, HINDCAST_SOURCE, DECODE_WORKERS and
+               PRODUCTS_DIR)
+
+Every system (origin and system of the file name) has its own products
+directory, {PRODUCTS_DIR}/{origin}_s{system}, so the products and climatology
+caches of different systems never mix. The products of a system and start
+month are run one at a time and for all the forecast
+years of its directory, so the report of the start month keeps every year;
+HINDCAST_SOURCE points to the hindcast of the start month ingested by the
+daemon, if any. A new hindcast clears the cached climatology files of its start
+month (SPI fits, quantile maps, and the climatology when the hindcast file was
+replaced) and reruns the products of all the forecasts of that start month:
+processed, failed (e.g. a forecast that arrived before its hindcast) and in
+flight. Jobs run in a bounded pool, each job decoding with cores // max_jobs
+processes, and a JSON state file records the stages done for every file, so a
+restart neither repeats finished work nor loses a half-processed file.
+
+    WATCH_DIRS=/MASIVO/cly/Forecast/1-Default_forecast/grib-data python ingest_daemon.py
+"""
+
+import os
+import re
+import sys
+import json
+import glob
+import time
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from grib_index import build_index, open_grib_selection
+from products import climatology_dir, write_json
+
+GRIB_NAME = re.compile(r"(?P<origin>[a-z_]+?)_s(?P<system>\w+?)_stmonth(?P<start_month>\d{2})_"
+                       r"(?:forecast(?P<year>\d{4})|hindcast(?P<hindcast>[\d-]+))_monthly")
+
+# Cached files of a start month that depend on the hindcast (one per grid and bias correction)
+CLIMATOLOGY_FILES = ['spi_gamma_grid_*.npz', 'quantile_map_*.npz']
+# Files of the incremental climatology, removed when a hindcast file is replaced
+# (replaced samples cannot be taken out of its moments)
+CLIMATOLOGY_STATE = ['climatology.json', 'moments.npz', 'grid_sketch.npz', 'basin_sketch.npz']
+
+
+def parse_grib_name(path):
+    """
+    Kind, start month and year of a GRIB file from its name.
+    :return: dict with kind ('forecast' or 'hindcast'), origin, system, start_month
+             and year (forecasts), or None if the name does not match
+    """
+    match = GRIB_NAME.search(os.path.basename(path))
+    if match is None:
+        return None
+    info = {'kind': 'forecast' if match['year'] else 'hindcast',
+            'origin': match['origin'], 'system': match['system'],
+            'start_month': int(match['start_month'])}
+    if match['year']:
+        info['year'] = int(match['year'])
+    return info
+
+
+def grib_complete(path):
+    """True if the file ends with the end marker of a GRIB message."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < 4:
+            return False
+        f.seek(-4, os.SEEK_END)
+        return f.read(4) == b'7777'
+
+
+class IngestState:
+    """JSON record of the files seen and the stages done for each of them."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.files = json.load(f)['files']
+
+    def get(self, path):
+        with self.lock:
+            return dict(self.files.get(path, {}))
+
+    def update(self, path, **fields):
+        with self.lock:
+            self.files.setdefault(path, {}).update(fields)
+            self._save()
+
+    def files_of(self, kind, info, stage=None):
+        """
+        Files of a kind with the system and start month of info, whatever their status.
+        :stage: only the files with this stage done
+        """
+        with self.lock:
+            return [path for path, entry in self.files.items()
+                    if entry.get('kind') == kind and (stage is None or stage in entry.get('stages_done', []))
+                    and all(entry.get(key) == info[key] for key in ('origin', 'system', 'start_month'))]
+
+    def _save(self):
+        # Written to a temporary file and renamed, so a crash never leaves a truncated state
+        write_json(self.path, {'files': self.files}, indent=1)
+
+
+def ingest_stage(path, info, settings):
+    build_index(path)
+
+
+def remap_stage(path, info, settings):
+    """Remap all the spatial variables of the file to the ERA5 grid of ERA5_GRID_FILE."""
+    if not settings.get('remap_output_dir'):
+        return
+    import numpy as np
+    import xarray as xr
+    from regrid import bilinear_weights, remap_dataset, output_names
+    era5 = xr.open_dataset(settings['era5_grid_file'])
+    lats, lons = np.array(era5['latitude']), np.array(era5['longitude'])
+    ds = open_grib_selection(path, settings['variables'], region={'lat': (lats.min() - 1, lats.max() + 1)})
+    weights = bilinear_weights(ds['lat'].values, ds['lon'].values, lats, lons)
+    block_dim = 'start_date' if info['kind'] == 'hindcast' else None
+    output = os.path.join(settings['remap_output_dir'], os.path.basename(path).rsplit('.', 1)[0] + '.nc')
+    output_names(remap_dataset(ds, weights, settings['variables'], block_dim=block_dim)).to_netcdf(output)
+    print(f"Remapped file created: {output}")
+
+
+def system_products_dir(products_dir, info):
+    """Products directory of the system of a file."""
+    return os.path.join(products_dir, f"{info['origin']}_s{info['system']}")
+
+
+def products_stage(path, info, settings):
+    """
+    Anomalies, statistics, report and maps of the system and start month.
+    :info: parsed name of the file, with the forecast years of the start month
+           (years) and the hindcast source (hindcast_source) set by the daemon
+    """
+    env = dict(os.environ, ORIGIN=info['origin'], SYSTEM=info['system'], START_MONTH=str(info['start_month']),
+               FORECAST_YEARS=','.join(str(y) for y in info.get('years', [info['year']])),
+               FOREDIR=os.path.dirname(path), DECODE_WORKERS=str(settings['decode_workers']))
+    if settings.get('products_dir'):
+        env['PRODUCTS_DIR'] = system_products_dir(settings['products_dir'], info)
+    if info.get('hindcast_source'):
+        env['HINDCAST_SOURCE'] = info['hindcast_source']
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BoxPlot_HindcastForecast.py')
+    subprocess.run([sys.executable, script], env=env, check=True)
+
+
+# Stages of each kind of file, in order
+PIPELINES = {
+    'forecast': [('ingest', ingest_stage), ('remap', remap_stage), ('products', products_stage)],
+    'hindcast': [('ingest', ingest_stage), ('remap', remap_stage)],
+}
+
+
+class IngestDaemon:
+    """Polls the input directories and runs the pipeline of every new complete file."""
+
+    def __init__(self, watch_dirs, state_file, max_jobs=2, pipelines=None, settings=None):
+        """
+        :watch_dirs: directories to watch
+        :state_file: JSON file with the processing state
+        :max_jobs: files processed at the same time
+        :pipelines: dict kind -> list of (stage name, function(path, info, settings))
+        :settings: dict passed to the stages (products_dir, variables, remap_output_dir...)
+        """
+        self.watch_dirs = list(watch_dirs)
+        self.state = IngestState(state_file)
+        self.pipelines = PIPELINES if pipelines is None else pipelines
+        self.settings = dict(settings or {})
+        # Decoding processes of each job, so that max_jobs jobs share the cores
+        self.settings.setdefault('decode_workers', max(1, (os.cpu_count() or 1) // max_jobs))
+        self.pool = ThreadPoolExecutor(max_workers=max_jobs)
+        self.running = {}
+        self._last_seen = {}
+        self._lock = threading.Lock()
+        self._month_locks = {}
+        # Start time and years of the last successful products run of every system and start month
+        self._month_runs = {}
+        # Files queued or running, and forecasts whose products became outdated meanwhile
+        self._active = set()
+        self._outdated = set()
+
+    def scan(self):
+        """New or changed GRIB files that are complete and not processed yet."""
+        ready = []
+        for directory in self.watch_dirs:
+            for path in sorted(glob.glob(os.path.join(directory, '*.grib')) + glob.glob(os.path.join(directory, '*.grb'))):
+                info = parse_grib_name(path)
+                if info is None or path in self.running:
+                    continue
+                stat = os.stat(path)
+                signature = [stat.st_size, stat.st_mtime]
+                entry = self.state.get(path)
+                # Done (or failed) files are only processed again when they change
+                if entry.get('signature') == signature and entry.get('status') in ('done', 'failed'):
+                    continue
+                # Complete when unchanged since the previous poll and closed by a GRIB end marker
+                previous, self._last_seen[path] = self._last_seen.get(path), signature
+                if previous == signature and grib_complete(path):
+                    ready.append((path, info, signature))
+        return ready
+
+    def submit(self, path, info, signature, stages=None):
+        """Queue the pipeline of a file (or only some of its stages)."""
+        entry = self.state.get(path)
+        # A changed file is processed again from the start
+        done = entry.get('stages_done', []) if entry.get('signature') == signature else []
+        replaced = bool(entry.get('stages_done')) and entry.get('signature') != signature
+        if stages is not None:
+            done = [name for name in done if name not in stages]
+        self.state.update(path, status='queued', signature=signature, stages_done=done, **info)
+        with self._lock:
+            self._active.add(path)
+        self.running[path] = self.pool.submit(self._run, path, info, done, replaced)
+
+    @staticmethod
+    def _month_key(info):
+        return info['origin'], info['system'], info['start_month']
+
+    def _month_lock(self, info):
+        """Lock of the products of a system and start month (its report and climatology caches are shared)."""
+        with self._lock:
+            return self._month_locks.setdefault(self._month_key(info), threading.Lock())
+
+    def _products_info(self, path, info):
+        """
+        info with the forecast years of the start month in the directory of path
+        and the hindcast ingested for it, if any (a file, or a glob of per-year files).
+        """
+        directory = os.path.dirname(path)
+        forecasts = [f for f in self.state.files_of('forecast', info, stage='ingest') if os.path.dirname(f) == directory]
+        years = sorted({parse_grib_name(f)['year'] for f in forecasts} | {info['year']})
+        hindcasts = sorted(h for h in self.state.files_of('hindcast', info, stage='ingest') if os.path.exists(h))
+        source = None
+        if len(hindcasts) == 1:
+            source = hindcasts[0]
+        elif hindcasts and len({os.path.dirname(h) for h in hindcasts}) == 1:
+            extension = os.path.splitext(hindcasts[0])[1]
+            source = os.path.join(os.path.dirname(hindcasts[0]),
+                                  f"{info['origin']}_s{info['system']}_stmonth{info['start_month']:02d}"
+                                  f"_hindcast*_monthly{extension}")
+        return dict(info, years=years, hindcast_source=source)
+
+    def _run(self, path, info, done, replaced=False):
+        try:
+            for name, stage in self.pipelines[info['kind']]:
+                if name in done:
+                    continue
+                print(f"[{name}] {os.path.basename(path)}")
+                self.state.update(path, status=f'running {name}')
+                if name == 'products':
+                    # One products run of a start month at a time, with all its years;
+                    # a run that started after this request already covers it
+                    requested = time.time()
+                    with self._month_lock(info):
+                        started, years = self._month_runs.get(self._month_key(info), (0, []))
+                        if started < requested or info['year'] not in years:
+                            products_info = self._products_info(path, info)
+                            started = time.time()
+                            stage(path, products_info, self.settings)
+                            self._month_runs[self._month_key(info)] = (started, products_info['years'])
+                else:
+                    stage(path, info, self.settings)
+                done = done + [name]
+                self.state.update(path, stages_done=done)
+            if info['kind'] == 'hindcast':
+                self._hindcast_updated(path, info, replaced)
+            status, error = 'done', None
+        except Exception as exc:
+            status, error = 'failed', str(exc)
+            print(f"Failed {path}: {exc}")
+        with self._lock:
+            outdated = path in self._outdated
+            self._outdated.discard(path)
+            self._active.discard(path)
+        if outdated:
+            # The hindcast changed while the products were running: run them again
+            self._mark_outdated(path)
+        else:
+            self.state.update(path, status=status, error=error)
+
+    def _mark_outdated(self, forecast):
+        """Queue the products of a forecast again on the next poll."""
+        entry = self.state.get(forecast)
+        self.state.update(forecast, stages_done=[s for s in entry.get('stages_done', []) if s != 'products'],
+                          status='outdated', error=None)
+        self._last_seen[forecast] = entry.get('signature')
+
+    def _hindcast_updated(self, path, info, replaced=False):
+        """
+        Clear the climatology caches of the start month (and the climatology if
+        the hindcast file was replaced) and rerun the products of all its forecasts.
+        """
+        if self.settings.get('products_dir'):
+            directory = climatology_dir(system_products_dir(self.settings['products_dir'], info), info['start_month'])
+            patterns = CLIMATOLOGY_FILES + (CLIMATOLOGY_STATE if replaced else [])
+            # Not while a products run of the start month may be writing them
+            with self._month_lock(info):
+                for pattern in patterns:
+                    for cached in glob.glob(os.path.join(directory, pattern)):
+                        os.remove(cached)
+        for forecast in self.state.files_of('forecast', info):
+            with self._lock:
+                active = forecast in self._active
+                if active:
+                    self._outdated.add(forecast)
+            if not active:
+                self._mark_outdated(forecast)
+
+    def poll(self):
+        """One poll: forget finished jobs and queue the ready files."""
+        for path, future in list(self.running.items()):
+            if future.done():
+                del self.running[path]
+        for path, info, signature in self.scan():
+            self.submit(path, info, signature)
+
+    def run(self, interval=60, once=False):
+        """Poll every interval seconds (once=True: until the ready files are processed)."""
+        try:
+            while True:
+                self.poll()
+                if once and not self.running and not self.scan():
+                    break
+                time.sleep(interval if not once else min(interval, 1))
+        finally:
+            self.pool.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Process new forecast and hindcast GRIB files as they arrive")
+    parser.add_argument('--once', action='store_true', help="process the files present and exit")
+    args = parser.parse_args()
+
+    watch_dirs = [d for d in os.getenv("WATCH_DIRS", "").split(os.pathsep) if d]
+    if not watch_dirs:
+        raise ValueError("WATCH_DIRS is missing. Please check your .env file.")
+    daemon = IngestDaemon(watch_dirs,
+                          state_file=os.getenv("INGEST_STATE_FILE", os.path.join(watch_dirs[0], 'ingest_state.json')),
+                          max_jobs=int(os.getenv("INGEST_MAX_JOBS", "2")),
+                          settings={'products_dir': os.getenv("PRODUCTS_DIR", '/sclim/cly/basins/results-basins/products'),
+                                    'variables': ['tprate'],
+                                    'remap_output_dir': os.getenv("REMAP_OUTPUT_DIR"),
+                                    'era5_grid_file': os.getenv("ERA5_GRID_FILE")})
+    daemon.run(interval=int(os.getenv("INGEST_POLL_SECONDS", "60")), once=args.once)
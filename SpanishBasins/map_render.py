@@ -0,0 +1,205 @@
+"""
+Anomaly maps over the Iberian Peninsula and the Canary Islands.
+
+Projecting Natural Earth coastlines and borders and the basin outlines is the
+slow part of drawing a cartopy map, so it is done once per domain: the
+projected geometries are cached as GeoParquet files
+
+    {cache_dir}/projected_{domain}.parquet
+
+and drawn as plain matplotlib paths. MapTemplate builds the figure once (axes,
+static outlines, colour bar and a QuadMesh per domain whose cells are projected
+once), and every map only updates the mesh values and the title before saving.
+render_maps renders many fields in a pool of processes, one template per worker:
+
+    jobs = [(field, "NDJFM 2023/2024", "anomaly_2023.png"), ...]
+    render_maps(jobs, dict(lats=lats, lons=lons, basins_cache_dir=geometry_cache_path))
+"""
+
+import os
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
+import geopandas as gpd
+from matplotlib import pyplot as plt
+from matplotlib.collections import PathCollection
+from matplotlib.colors import BoundaryNorm
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+try:
+    from cartopy.mpl.path import shapely_to_path
+except ImportError:  # cartopy < 0.23
+    from cartopy.mpl.patch import geos_to_path as shapely_to_path
+
+from geometry_cache import load_basins
+
+# Map domains: extent (lon_min, lon_max, lat_min, lat_max) and projection
+DOMAINS = {
+    'iberia': {'extent': (-10, 4.5, 35.5, 44.5),
+               'projection': ccrs.LambertConformal(central_longitude=-3.5, central_latitude=40,
+                                                   standard_parallels=(37, 43))},
+    'canarias': {'extent': (-18.5, -13.2, 27.4, 29.5),
+                 'projection': ccrs.PlateCarree()},
+}
+
+# Natural Earth features drawn under the basin outlines
+FEATURES = {
+    'coastline': cfeature.NaturalEarthFeature('physical', 'coastline', '50m'),
+    'borders': cfeature.NaturalEarthFeature('cultural', 'admin_0_boundary_lines_land', '50m'),
+}
+
+# Default colour scale of the relative anomalies (%)
+ANOMALY_LEVELS = np.arange(-50, 51, 10)
+
+
+def _domain_box(domain, margin=1.0):
+    lon_min, lon_max, lat_min, lat_max = DOMAINS[domain]['extent']
+    return shapely.box(lon_min - margin, lat_min - margin, lon_max + margin, lat_max + margin)
+
+
+def _project(geometries, domain):
+    """Clip geographic geometries to a domain and project them."""
+    projection = DOMAINS[domain]['projection']
+    clipped = shapely.intersection(np.asarray(geometries), _domain_box(domain))
+    clipped = clipped[~shapely.is_empty(clipped)]
+    return [projection.project_geometry(g, ccrs.PlateCarree()) for g in clipped]
+
+
+def build_projected_features(domain, basins_cache_dir, cache_dir):
+    """Project the features and basin outlines of a domain and cache them as GeoParquet."""
+    print(f"Projecting map features of {domain}")
+    names, geometries = [], []
+    for name, feature in FEATURES.items():
+        projected = _project(list(feature.geometries()), domain)
+        names += [name] * len(projected)
+        geometries += projected
+    basins = load_basins(basins_cache_dir, 'plot')
+    projected = _project(shapely.boundary(basins.geometry.values), domain)
+    names += ['basins'] * len(projected)
+    geometries += projected
+    os.makedirs(cache_dir, exist_ok=True)
+    gdf = gpd.GeoDataFrame({'feature': names}, geometry=geometries)
+    gdf.to_parquet(os.path.join(cache_dir, f"projected_{domain}.parquet"))
+    return gdf
+
+
+@lru_cache(maxsize=None)
+def projected_features(domain, basins_cache_dir, cache_dir=None):
+    """
+    Projected geometries of a domain, grouped by feature.
+    :cache_dir: directory of the projected cache (basins_cache_dir by default)
+    :return: dict feature name -> list of projected geometries
+    """
+    cache_dir = basins_cache_dir if cache_dir is None else cache_dir
+    path = os.path.join(cache_dir, f"projected_{domain}.parquet")
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(
+            os.path.join(basins_cache_dir, 'basins_plot.parquet')):
+        gdf = gpd.read_parquet(path)
+    else:
+        gdf = build_projected_features(domain, basins_cache_dir, cache_dir)
+    return {name: list(group.geometry.values) for name, group in gdf.groupby('feature')}
+
+
+def _paths(geometries):
+    """Matplotlib paths of projected geometries."""
+    paths = []
+    for geometry in geometries:
+        path = shapely_to_path(geometry)
+        paths.extend(path if isinstance(path, list) else [path])  # geos_to_path returns a list
+    return paths
+
+
+# Style of the static outlines
+OUTLINE_STYLES = {
+    'coastline': dict(edgecolor='black', linewidth=0.6),
+    'borders': dict(edgecolor='dimgray', linewidth=0.5, linestyle='--'),
+    'basins': dict(edgecolor='black', linewidth=0.4, alpha=0.7),
+}
+
+
+class MapTemplate:
+    """Reusable figure: the outlines and grid cells are projected once, only the values change."""
+
+    def __init__(self, lats, lons, basins_cache_dir, cache_dir=None, domains=('iberia', 'canarias'),
+                 levels=ANOMALY_LEVELS, cmap='BrBG', label="Precipitation Anomaly (%)"):
+        """
+        :lats, lons: 1-D coordinates of the fields to draw
+        :basins_cache_dir: directory of the geometry cache (geometry_cache.py)
+        :cache_dir: directory of the projected features (basins_cache_dir by default)
+        """
+        lats = np.asarray(lats)
+        lons = np.where(np.asarray(lons) > 180, np.asarray(lons) - 360, lons)  # 0-360 grids to -180-180
+        self.fig = plt.figure(figsize=(10, 8))
+        self.meshes = []
+        norm = BoundaryNorm(levels, plt.get_cmap(cmap).N, extend='both')
+        for n, domain in enumerate(domains):
+            config = DOMAINS[domain]
+            # Main domain on the full figure, the others as insets in the lower left corner
+            rect = [0.05, 0.12, 0.9, 0.8] if n == 0 else [0.06, 0.13, 0.25, 0.18]
+            ax = self.fig.add_axes(rect, projection=config['projection'])
+            ax.set_extent(config['extent'], crs=ccrs.PlateCarree())
+            # Grid cells of the domain only
+            lon_min, lon_max, lat_min, lat_max = config['extent']
+            lat_sel = np.where((lats >= lat_min - 1) & (lats <= lat_max + 1))[0]
+            lon_sel = np.where((lons >= lon_min - 1) & (lons <= lon_max + 1))[0]
+            lon_sel = lon_sel[np.argsort(lons[lon_sel])]
+            mesh = ax.pcolormesh(lons[lon_sel], lats[lat_sel], np.zeros((len(lat_sel), len(lon_sel))),
+                                 transform=ccrs.PlateCarree(), shading='nearest', cmap=cmap, norm=norm)
+            self.meshes.append((mesh, lat_sel, lon_sel))
+            for name, geometries in projected_features(domain, basins_cache_dir, cache_dir).items():
+                ax.add_collection(PathCollection(_paths(geometries), facecolor='none',
+                                                 transform=ax.transData, **OUTLINE_STYLES[name]))
+        cax = self.fig.add_axes([0.15, 0.06, 0.7, 0.025])
+        self.fig.colorbar(self.meshes[0][0], cax=cax, orientation='horizontal', label=label)
+        self.title = self.fig.suptitle("", fontsize=14)
+
+    def render(self, field, title, path, dpi=150):
+        """
+        Draw a field (lat, lon) and save the figure.
+        :return: path of the saved figure
+        """
+        field = np.ma.masked_invalid(np.asarray(field))
+        for mesh, lat_sel, lon_sel in self.meshes:
+            mesh.set_array(field[np.ix_(lat_sel, lon_sel)])
+        self.title.set_text(title)
+        self.fig.savefig(path, dpi=dpi)
+        print(f"Map saved at {path}")
+        return path
+
+    def close(self):
+        plt.close(self.fig)
+
+
+# Template of each worker process of render_maps
+_worker_template = None
+
+
+def _init_worker(template_kwargs):
+    global _worker_template
+    _worker_template = MapTemplate(**template_kwargs)
+
+
+def _render_job(job):
+    return _worker_template.render(*job)
+
+
+def render_maps(jobs, template_kwargs, max_workers=None):
+    """
+    Render many maps that share a template.
+    :jobs: list of (field, title, path)
+    :template_kwargs: arguments of MapTemplate
+    :max_workers: processes (None: one per core, 1: render in this process)
+    :return: paths of the saved figures
+    """
+    # The projected features are cached on disk before the workers start
+    for domain in template_kwargs.get('domains', ('iberia', 'canarias')):
+        projected_features(domain, template_kwargs['basins_cache_dir'], template_kwargs.get('cache_dir'))
+    if max_workers == 1 or len(jobs) <= 1:
+        template = MapTemplate(**template_kwargs)
+        paths = [template.render(*job) for job in jobs]
+        template.close()
+        return paths
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(template_kwargs,)) as pool:
+        return list(pool.map(_render_job, jobs))
@@ -0,0 +1,152 @@
+"""
+Several seasonal forecasting systems in one (system, member, start_date, forecastMonth) layout.
+
+Burst ensembles (ECMWF, DWD, Météo-France, CMCC) start all their members on the
+same date, while lagged ensembles (UK Met Office) start them on several days
+and are indexed by the nominal start date (indexingDate), so they are read with
+lagged=True. Every system is then normalised:
+
+    - the members are renumbered 0..n-1 in a 'member' dimension;
+    - the start dates are reduced to the first day of their month, so burst
+      and lagged starts of the same month line up;
+    - the systems are concatenated lazily along 'system': only the start dates
+      common to all of them are kept and ensembles smaller than the largest one
+      are padded with NaN members, without reading or copying any field.
+
+multi_system_anomalies then runs the blocked anomalies of all the systems as
+one batched computation (the system dimension is a batch dimension of
+anomalies.blocked_basin_anomalies) and adds a multi-model ensemble (MME)
+pooling the members of all the systems, each relative to its own climatology.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from anomalies import COMPACT_DTYPE, blocked_basin_anomalies
+from grib_index import open_grib_selection, add_time_coords
+from grib_parallel import open_grib_parallel
+
+# CDS origin, system version and ensemble type of the systems
+SYSTEMS = {
+    'ecmwf': {'origin': 'ecmwf', 'system': '51', 'lagged': False},
+    'ukmo': {'origin': 'ukmo', 'system': '604', 'lagged': True},
+    'dwd': {'origin': 'dwd', 'system': '21', 'lagged': False},
+    'meteo_france': {'origin': 'meteo_france', 'system': '8', 'lagged': False},
+    'cmcc': {'origin': 'cmcc', 'system': '35', 'lagged': False},
+}
+
+MME = 'MME'
+
+
+def normalize_system(ds):
+    """
+    Common layout of one system: member dimension 0..n-1 and monthly start dates.
+    :ds: xr.Dataset returned by grib_index.open_grib_selection / grib_parallel.open_grib_parallel
+    """
+    ds = ds.drop_vars(['valid_time', 'start_month'], errors='ignore')
+    ds = ds.rename({'number': 'member'}).assign_coords(member=np.arange(ds.sizes['number']))
+    start = pd.DatetimeIndex(np.atleast_1d(ds['start_date'].values)).to_period('M').to_timestamp()
+    if 'start_date' in ds.dims:
+        return ds.assign_coords(start_date=start)
+    return ds.drop_vars('start_date')  # single start date: set again after the concatenation
+
+
+def combine_systems(datasets):
+    """
+    Lazy concatenation of normalised systems along a 'system' dimension.
+    :datasets: dict system name -> normalised xr.Dataset
+    :return: xr.Dataset (system, member, [start_date,] forecastMonth, lat, lon) with
+             an 'n_members' coordinate (members of every system before the padding)
+    """
+    names = list(datasets)
+    n_members = [datasets[name].sizes['member'] for name in names]
+    pieces = list(datasets.values())
+    if 'start_date' in pieces[0].dims:
+        # Start dates common to all the systems, the members are padded in the concatenation
+        pieces = xr.align(*pieces, join='inner', exclude=['member'])
+    ds = xr.concat(pieces, dim=pd.Index(names, name='system'), join='outer', fill_value=np.nan)
+    return ds.assign_coords(n_members=('system', n_members))
+
+
+def open_multi_system(sources, variables, forecast_months, kind='hindcast', systems=SYSTEMS,
+                      start_date=None, **kwargs):
+    """
+    Open the GRIB data of several systems in the common layout.
+    :sources: dict system name -> hindcast source (file, directory or glob) or forecast file
+    :forecast_months: forecastMonths to read (e.g. NDJFM_MONTHS[start_month])
+    :kind: 'hindcast' (pieces opened with grib_parallel) or 'forecast'
+    :start_date: start date of the forecasts (first day of the start month)
+    :return: xr.Dataset (system, member, [start_date,] forecastMonth, lat, lon), dask-backed
+    """
+    datasets = {}
+    for name, source in sources.items():
+        lagged = systems[name]['lagged']
+        if kind == 'hindcast':
+            ds = open_grib_parallel(source, variables, forecast_months, lagged=lagged, **kwargs)
+        else:
+            ds = open_grib_selection(source, variables, forecast_months, lagged=lagged, **kwargs)
+        datasets[name] = normalize_system(ds)
+    ds = combine_systems(datasets)
+    if kind == 'forecast':
+        start = pd.Timestamp(start_date) if start_date is not None else None
+        if start is None:
+            raise ValueError("start_date is needed to combine forecasts")
+        ds = ds.assign_coords(start_date=start)
+    return add_time_coords(ds)
+
+
+def _system_result(result, s, hcst_valid, fcst_valid):
+    """Basin result of one system of a batched result, without the padded members."""
+    out = {'n_points': result['n_points']}
+    for key, value in result.items():
+        if key == 'n_points':
+            continue
+        value = np.asarray(value)
+        if value.ndim == 1:  # per system statistic
+            out[key] = value[s]
+        else:  # (samples, system)
+            valid = hcst_valid if key.startswith(('hindcast', 'hcst')) else fcst_valid
+            out[key] = value[valid[:, s], s]
+    return out
+
+
+def _pooled_result(results):
+    """Multi-model ensemble of the results of several systems (members pooled)."""
+    out = {'n_points': results[0]['n_points']}
+    for prefix, samples_key in [('hcst', 'hindcast_anomaly_basinmean'), ('fcst', 'forecast_anomaly_basinmean')]:
+        counts = np.array([len(r[samples_key]) for r in results])
+        means = np.array([r[f'{prefix}_mean'] for r in results])
+        stds = np.array([r[f'{prefix}_std'] for r in results])
+        mean = np.sum(counts * means) / counts.sum()
+        out[f'{prefix}_mean'] = mean
+        out[f'{prefix}_std'] = np.sqrt(np.sum(counts * (stds ** 2 + (means - mean) ** 2)) / counts.sum())
+    for key in results[0]:
+        if np.ndim(results[0][key]) == 1:
+            out[key] = np.concatenate([r[key] for r in results])
+    return out
+
+
+def multi_system_anomalies(winter_hcst, winter_fcst, basin_points, memory_budget, dtype=COMPACT_DTYPE):
+    """
+    Basin anomalies of all the systems in one batched computation, plus the MME.
+    :winter_hcst: xr.DataArray (system, member, start_date, lat, lon)
+    :winter_fcst: xr.DataArray (system, member, lat, lon)
+    :return: dict system name (and MME) -> dict basin_id -> result as in
+             anomalies.blocked_basin_anomalies
+    """
+    systems = list(winter_hcst['system'].values)
+    hcst_stacked = winter_hcst.stack(new_dim=('member', 'start_date')).transpose('new_dim', 'system', 'lat', 'lon')
+    fcst = winter_fcst.transpose('member', 'system', 'lat', 'lon')
+    batched = blocked_basin_anomalies(hcst_stacked, fcst, basin_points, memory_budget,
+                                      dtype=dtype, hcst_dim='new_dim', fcst_dim='member')
+
+    # Samples of the members of every system (the padded members are NaN)
+    hcst_members = hcst_stacked['member'].values
+    hcst_valid = hcst_members[:, np.newaxis] < winter_hcst['n_members'].values[np.newaxis, :]
+    fcst_valid = fcst['member'].values[:, np.newaxis] < winter_fcst['n_members'].values[np.newaxis, :]
+
+    results = {name: {i: _system_result(r, s, hcst_valid, fcst_valid) for i, r in batched.items()}
+               for s, name in enumerate(systems)}
+    results[MME] = {i: _pooled_result([results[name][i] for name in systems]) for i in basin_points}
+    return results
@@ -5,7 +5,8 @@ import xarray as xr
 import numpy as np
 import geopandas as gpd
 import matplotlib.pyplot as plt
-from shapely.geometry import Point
+from geometry_cache import load_basins, basin_grid_points
+from hierarchy import GROUPS
 from scipy.spatial import cKDTree
 import pandas as pd
 
@@ -15,10 +16,12 @@ masivo_path = '/MASIVO/cly'
 results_path = '/sclim/cly/basins/results-basins/coord-trim'
 results_path_csv= '/sclim/cly/basins/results-basins/coord-trim/csv-files'
 
-# Load shapefile for basins
+# Load basins from the geometry cache (built from the shapefile on the first run)
 shapefile_basins = 'DemarcacionesHidrograficasPHC2015_2021.shp'
 shapefile = os.path.join(shapefile_path, shapefile_basins)
-basins = gpd.read_file(shapefile)
+geometry_cache_path = os.path.join(shapefile_path, 'geometry-cache')
+basins = load_basins(geometry_cache_path, 'exact', shapefile=shapefile)
+basins_plot = load_basins(geometry_cache_path, 'plot')  # simplified geometries for drawing
 
 # List of GRIB files with different resolutions and corresponding resolution names
 grib_files = [
@@ -33,13 +36,7 @@ grib_files = [
 ]
 
 # Define basin groups
-groups = {
-    "Vertiente Atlántico Norte y Cantábrico": [1, 3, 4, 17],
-    "Vertiente Atlántico Sur": [8, 9, 15],
-    "Vertiente Mediterránea": [0, 2, 10, 11, 12, 13, 14, 16],
-    "Cuencas Interiores": [5, 6, 7],
-    "Islas Canarias": [18, 19, 20, 21, 22, 23, 24]
-}
+groups = GROUPS
 
 # Group configurations for each area (vertiente) 
 configurations = {
@@ -68,24 +65,19 @@ for grib_info in grib_files:
         basin_name = basin['nameText'] if 'nameText' in basin else f"Basin_{i}"
         print(f'Processing basin: {basin_name}')
 
-        # Calculate the basin's centroid and the nearest grid point
-        basin_centroid = basin.geometry.centroid
-        _, idx = tree.query([basin_centroid.x, basin_centroid.y])
+        # Nearest grid point to the basin's centroid (precomputed in the cache)
+        _, idx = tree.query([basin['centroid_x'], basin['centroid_y']])
         nearest_lon, nearest_lat = grid_points[idx]
 
-        # Find points within the basin
-        points_within_basin = []
-        for lat_idx, lat in enumerate(lats):
-            for lon_idx, lon in enumerate(lons):
-                point = Point(lon, lat)
-                if basin.geometry.contains(point):
-                    points_within_basin.append({
-                        "x_grid": lat_idx,
-                        "y_grid": lon_idx,
-                        "latitude": lat,
-                        "longitude": lon,
-                        "basin_name": basin_name
-                    })
+        # Find points within the basin (exact geometry, the simplified levels are only for drawing)
+        lat_idx, lon_idx = basin_grid_points(basin.geometry, lats, lons)
+        points_within_basin = [{
+            "x_grid": la,
+            "y_grid": lo,
+            "latitude": lats[la],
+            "longitude": lons[lo],
+            "basin_name": basin_name
+        } for la, lo in zip(lat_idx, lon_idx)]
 
         if not points_within_basin:
             points_within_basin.append({
@@ -119,14 +111,14 @@ for grib_info in grib_files:
                 ax_map.set_title(f"{group}\n {basin_name}", fontsize=16, fontweight='bold', loc='center')
 
                 # Plot all basins in light gray
-                basins.plot(ax=ax_map, color='lightgrey', edgecolor='black', alpha=0.5)
+                basins_plot.plot(ax=ax_map, color='lightgrey', edgecolor='black', alpha=0.5)
 
                 # Plot group basins in color
-                group_basins = basins[basins.index.isin(indices)]
+                group_basins = basins_plot[basins_plot.index.isin(indices)]
                 group_basins.plot(ax=ax_map, color=config["color"], edgecolor='black', alpha=0.7)
 
                 # Highlight current basin
-                gpd.GeoDataFrame(geometry=[basin.geometry]).plot(ax=ax_map, color="mistyrose", edgecolor='red', linewidth=3)
+                basins_plot.iloc[[i]].plot(ax=ax_map, color="mistyrose", edgecolor='red', linewidth=3)
                 break
 
         ax_map.set_xlabel("Grid Lon", fontsize=14)
@@ -0,0 +1,132 @@
+"""
+Precomputed basin anomaly products.
+
+For every start month and forecast year the basin-mean anomalies are saved as
+plain .npy arrays (so they can be memory-mapped by readers) next to a JSON
+file describing the basins:
+
+    {products_dir}/stmonth{MM}/{year}/hindcast_anomaly_basinmean.npy  (basins, hindcast samples)
+    {products_dir}/stmonth{MM}/{year}/forecast_anomaly_basinmean.npy  (basins, forecast members)
+    {products_dir}/stmonth{MM}/{year}/basins.json
+    {products_dir}/stmonth{MM}/{year}/{name}.npy                      gridded products (save_grid_product)
+    {products_dir}/stmonth{MM}/climatology/                           (climatology.Climatology.save)
+
+Every file is written to a temporary file and renamed over the previous one
+(atomic_write), so the query service and concurrent runs never read a partly
+written product or cache.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+
+def atomic_write(path, write):
+    """
+    Write a file with write(tmp_path) to a temporary file in the same
+    directory, then rename it over path.
+    """
+    root, ext = os.path.splitext(path)
+    tmp = f"{root}.{os.getpid()}-{threading.get_ident()}.tmp{ext}"  # keeps the extension for np.save/np.savez
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def write_json(path, obj, **kwargs):
+    """Write obj as JSON with atomic_write."""
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(obj, f, **kwargs)
+    atomic_write(path, write)
+
+
+def product_dir(products_dir, start_month, forecast_year):
+    """Directory of the products of a start month and forecast year."""
+    return os.path.join(products_dir, f"stmonth{int(start_month):02d}", str(forecast_year))
+
+
+def climatology_dir(products_dir, start_month):
+    """Directory of the climatology of a start month."""
+    return os.path.join(products_dir, f"stmonth{int(start_month):02d}", "climatology")
+
+
+def cache_key(*parts):
+    """
+    Short key of the settings a cached file depends on (grid, observations...),
+    used in the cached file names so that changing them never reuses a stale file.
+    """
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()[:12]
+
+
+def save_basin_products(products_dir, start_month, forecast_year, basin_points, basin_results,
+                        dtype=np.float32):
+    """
+    Save the basin anomalies of a forecast year.
+    :basin_points: dict returned by basins.load_basin_points
+    :basin_results: dict returned by anomalies.blocked_basin_anomalies
+    """
+    path = product_dir(products_dir, start_month, forecast_year)
+    os.makedirs(path, exist_ok=True)
+    for name in ['hindcast_anomaly_basinmean', 'forecast_anomaly_basinmean']:
+        values = np.stack([basin_results[i][name] for i in basin_points]).astype(dtype)
+        atomic_write(os.path.join(path, f"{name}.npy"), lambda tmp: np.save(tmp, values))
+    meta = {
+        'start_month': int(start_month),
+        'forecast_year': int(forecast_year),
+        'basins': [{'id': int(i),
+                    'name': str(p['name']),
+                    'hcst_mean': float(basin_results[i]['hcst_mean']),
+                    'hcst_std': float(basin_results[i]['hcst_std']),
+                    'fcst_mean': float(basin_results[i]['fcst_mean']),
+                    'fcst_std': float(basin_results[i]['fcst_std'])}
+                   for i, p in basin_points.items()]
+    }
+    write_json(os.path.join(path, 'basins.json'), meta, indent=1)  # written last (query_service.py cache key)
+    print(f"Basin products saved at {path}")
+
+
+def save_grid_product(products_dir, start_month, forecast_year, name, values, dtype=np.float32):
+    """Save a gridded product of a forecast year, e.g. the SPI of the forecast members."""
+    path = product_dir(products_dir, start_month, forecast_year)
+    os.makedirs(path, exist_ok=True)
+    atomic_write(os.path.join(path, f"{name}.npy"), lambda tmp: np.save(tmp, np.asarray(values, dtype=dtype)))
+    print(f"Product {name} saved at {path}")
+
+
+def load_basin_products(products_dir, start_month, forecast_year, mmap_mode='r'):
+    """
+    Open the basin anomalies of a forecast year (memory-mapped by default).
+    :return: (meta dict, hindcast array, forecast array)
+    """
+    path = product_dir(products_dir, start_month, forecast_year)
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"No products for start month {start_month} and year {forecast_year}")
+    with open(os.path.join(path, 'basins.json')) as f:
+        meta = json.load(f)
+    hcst = np.load(os.path.join(path, 'hindcast_anomaly_basinmean.npy'), mmap_mode=mmap_mode)
+    fcst = np.load(os.path.join(path, 'forecast_anomaly_basinmean.npy'), mmap_mode=mmap_mode)
+    return meta, hcst, fcst
+
+
+def tercile_probabilities(hindcast_anomaly, forecast_anomaly):
+    """
+    Fraction of forecast members below, within and above the hindcast terciles.
+    :return: dict with the tercile limits and the three probabilities
+    """
+    lower, upper = np.percentile(hindcast_anomaly, [100 / 3, 200 / 3])
+    forecast_anomaly = np.asarray(forecast_anomaly)
+    below = np.mean(forecast_anomaly < lower)
+    above = np.mean(forecast_anomaly > upper)
+    return {
+        'lower_tercile': float(lower),
+        'upper_tercile': float(upper),
+        'below_normal': float(below),
+        'near_normal': float(1 - below - above),
+        'above_normal': float(above)
+    }
@@ -0,0 +1,164 @@
+"""
+Empirical quantile-mapping bias correction of the seasonal forecasts.
+
+For every grid cell and lead (forecastMonth) the quantiles of the hindcast and
+of the observations (ERA5) valid at the same months are computed once and
+cached as compact float32 arrays:
+
+    model_q (quantile, forecastMonth, lat, lon)   hindcast quantiles
+    obs_q   (quantile, forecastMonth, lat, lon)   ERA5 quantiles
+
+A value x is corrected by locating it between the hindcast quantiles of its
+cell and lead and interpolating linearly between the matching ERA5 quantiles.
+Beyond the extreme quantiles the correction of the nearest extreme is added.
+Cells without observations (see match_grid) are left uncorrected.
+The maps are applied with xr.apply_ufunc, so dask-backed data (one chunk per
+GRIB message) are corrected field by field when the blocks of
+anomalies.blocked_basin_anomalies are computed, within their memory budget.
+"""
+
+import numpy as np
+import xarray as xr
+
+from blocking import block_size
+from products import atomic_write
+
+# Probability levels of the maps
+DEFAULT_QUANTILES = np.linspace(0, 1, 51)
+
+
+class QuantileMap:
+    """Hindcast and observed quantiles of every lead and grid cell."""
+
+    def __init__(self, quantiles, model_q, obs_q, forecast_months, lat, lon, dtype=np.float32):
+        self.quantiles = np.asarray(quantiles, dtype=np.float64)
+        self.model_q = np.asarray(model_q, dtype=dtype)
+        self.obs_q = np.asarray(obs_q, dtype=dtype)
+        self.forecast_months = np.asarray(forecast_months)
+        self.lat = np.asarray(lat)
+        self.lon = np.asarray(lon)
+
+    def _as_dataarray(self, values):
+        return xr.DataArray(values, dims=('quantile', 'forecastMonth', 'lat', 'lon'),
+                            coords={'quantile': self.quantiles, 'forecastMonth': self.forecast_months,
+                                    'lat': self.lat, 'lon': self.lon})
+
+    def apply(self, data, lower_bound=0):
+        """
+        Bias-correct a xr.DataArray (..., forecastMonth, lat, lon) on the grid of the map.
+        :lower_bound: minimum corrected value (0 for precipitation), None for no bound
+        :return: xr.DataArray, lazy if data is dask-backed
+        """
+        model_q = self._as_dataarray(self.model_q).sel(forecastMonth=data['forecastMonth'])
+        obs_q = self._as_dataarray(self.obs_q).sel(forecastMonth=data['forecastMonth'])
+        # Same cells as data (the coordinates of the map may differ in float rounding)
+        model_q = model_q.assign_coords(lat=data['lat'], lon=data['lon'])
+        obs_q = obs_q.assign_coords(lat=data['lat'], lon=data['lon'])
+        corrected = xr.apply_ufunc(map_quantiles, data, model_q, obs_q,
+                                   input_core_dims=[[], ['quantile'], ['quantile']],
+                                   kwargs={'lower_bound': lower_bound},
+                                   dask='parallelized', output_dtypes=[data.dtype])
+        return corrected.transpose(*data.dims).assign_attrs(data.attrs)
+
+    def save(self, path):
+        """Save the map to a .npz file (atomically, see products.atomic_write)."""
+        atomic_write(path, lambda tmp: np.savez(tmp, quantiles=self.quantiles, model_q=self.model_q, obs_q=self.obs_q,
+                                                forecast_months=self.forecast_months, lat=self.lat, lon=self.lon))
+
+    @classmethod
+    def load(cls, path):
+        """Load a map saved with QuantileMap.save."""
+        with np.load(path) as data:
+            return cls(data['quantiles'], data['model_q'], data['obs_q'],
+                       data['forecast_months'], data['lat'], data['lon'], dtype=data['model_q'].dtype)
+
+
+def map_quantiles(values, model_q, obs_q, lower_bound=0):
+    """
+    Quantile mapping of values with the quantiles of their cells.
+    :values: array (...)
+    :model_q, obs_q: arrays (..., quantile) broadcastable against values, sorted along quantile
+    :return: corrected array with the shape and dtype of values
+    """
+    values = np.asarray(values)
+    x = values.astype(np.float64)
+    n_q = model_q.shape[-1]
+    # Number of hindcast quantiles <= x, counted one quantile at a time to keep
+    # the memory of a (values, quantile) comparison out
+    position = np.zeros(np.broadcast_shapes(x.shape, model_q.shape[:-1]), dtype=np.intp)
+    for k in range(n_q):
+        position += x >= model_q[..., k]
+    upper = np.clip(position, 1, n_q - 1)[..., np.newaxis]
+    lower = upper - 1
+    model_q = np.broadcast_to(model_q, position.shape + (n_q,))
+    obs_q = np.broadcast_to(obs_q, position.shape + (n_q,))
+    m0 = np.take_along_axis(model_q, lower, axis=-1)[..., 0].astype(np.float64)
+    m1 = np.take_along_axis(model_q, upper, axis=-1)[..., 0].astype(np.float64)
+    o0 = np.take_along_axis(obs_q, lower, axis=-1)[..., 0].astype(np.float64)
+    o1 = np.take_along_axis(obs_q, upper, axis=-1)[..., 0].astype(np.float64)
+    # Tied hindcast quantiles (e.g. dry cells) map to the lower observed quantile
+    span = m1 - m0
+    weight = np.clip(np.divide(x - m0, span, out=np.zeros_like(span), where=span > 0), 0, 1)
+    corrected = o0 + weight * (o1 - o0)
+    # Constant correction beyond the extreme quantiles
+    corrected += np.minimum(x - model_q[..., 0], 0) + np.maximum(x - model_q[..., -1], 0)
+    if lower_bound is not None:
+        corrected = np.maximum(corrected, lower_bound)
+    return corrected.astype(values.dtype, copy=False)
+
+
+def match_grid(obs, lat, lon, tolerance=None):
+    """
+    Observations at the cells of the model grid.
+    The longitudes of obs are brought to the convention of the model grid
+    (0..360 or -180..180) and every cell takes the nearest observation within
+    tolerance; cells without one are NaN (left uncorrected by the map).
+    :obs: xr.DataArray (..., lat, lon)
+    :lat, lon: 1-D coordinates of the model grid
+    :tolerance: maximum distance in degrees, half the model grid spacing by default
+    :return: xr.DataArray (..., lat, lon) with the coordinates of the model grid
+    """
+    lat, lon = np.asarray(lat), np.asarray(lon)
+    if tolerance is None:
+        tolerance = 0.5 * min(np.abs(np.diff(lat)).min(), np.abs(np.diff(lon)).min())
+    obs_lon = obs['lon'] % 360 if np.any(lon > 180) else (obs['lon'] + 180) % 360 - 180
+    obs = obs.assign_coords(lon=obs_lon).sortby('lat').sortby('lon')
+    matched = obs.reindex(lat=lat, lon=lon, method='nearest', tolerance=tolerance)
+    n_cells = int(matched.notnull().any([d for d in matched.dims if d not in ('lat', 'lon')]).sum())
+    if n_cells == 0:
+        raise ValueError("The observations do not cover any cell of the model grid")
+    print(f"Observations matched to {n_cells} of {len(lat) * len(lon)} model cells")
+    return matched.assign_coords(lat=lat, lon=lon)
+
+
+def fit_quantile_map(hcst, obs, memory_budget, quantiles=DEFAULT_QUANTILES, dtype=np.float32):
+    """
+    Quantile maps of every lead and grid cell from the hindcast and the observations.
+    :hcst: xr.DataArray (number, start_date, forecastMonth, lat, lon) with the
+           valid_time (start_date, forecastMonth) coordinate of the loaders
+    :obs: xr.DataArray (valid_time, lat, lon) on the same grid and in the same units
+          (match_grid); cells without observations get an identity map
+    :memory_budget: bytes (int) or string such as '4GB'; the cells of a lead are
+                    processed in blocks of latitude rows that fit in it
+    :return: QuantileMap
+    """
+    n_lat, n_lon = hcst.sizes['lat'], hcst.sizes['lon']
+    n_samples = hcst.sizes['number'] * hcst.sizes['start_date']
+    rows = block_size(n_lat, n_samples * n_lon * np.dtype(np.float64).itemsize, memory_budget)
+    shape = (len(quantiles), hcst.sizes['forecastMonth'], n_lat, n_lon)
+    model_q = np.empty(shape, dtype=dtype)
+    obs_q = np.empty(shape, dtype=dtype)
+    obs = obs.transpose('valid_time', 'lat', 'lon')
+    for lead in range(hcst.sizes['forecastMonth']):
+        lead_hcst = hcst.isel(forecastMonth=lead).transpose('number', 'start_date', 'lat', 'lon')
+        # Observations valid at the months of the hindcast samples of the lead
+        lead_obs = obs.sel(valid_time=lead_hcst['valid_time'].values)
+        print(f" - Quantile map of forecastMonth {int(hcst['forecastMonth'][lead])}")
+        for start in range(0, n_lat, rows):
+            block = slice(start, start + rows)
+            values = np.asarray(lead_hcst.isel(lat=block).values, dtype=np.float64)
+            model_q[:, lead, block] = np.quantile(values.reshape(n_samples, -1, n_lon), quantiles, axis=0)
+            block_obs_q = np.quantile(np.asarray(lead_obs.isel(lat=block).values), quantiles, axis=0)
+            obs_q[:, lead, block] = np.where(np.isnan(block_obs_q), model_q[:, lead, block], block_obs_q)
+    return QuantileMap(quantiles, model_q, obs_q, hcst['forecastMonth'].values,
+                       hcst['lat'].values, hcst['lon'].values, dtype=dtype)
@@ -0,0 +1,181 @@
+"""
+Streaming quantile sketches for per-grid-point climatological percentiles.
+
+Exact percentiles over number x start_date need the whole stacked hindcast in
+memory. GridQuantileSketch keeps a KLL-style sketch for every grid cell instead:
+the hindcast is fed one start date (year) at a time and the sketch answers any
+percentile query with a bounded rank error and a memory footprint that grows
+only logarithmically with the number of samples.
+
+Every cell of a grid receives the same number of samples per update, so the
+compaction schedule is shared by all cells and each level of the sketch is a
+plain (items, cells) array. Sketches built on different nodes can be merged
+and saved to / loaded from .npz files.
+"""
+
+import numpy as np
+
+
+class GridQuantileSketch:
+    """Mergeable KLL-style quantile sketch for every cell of a grid."""
+
+    def __init__(self, shape, k=200, c=2/3, seed=None, dtype=np.float64):
+        """
+        :shape: shape of the grid (e.g. (lat, lon) or (n_basins,))
+        :k: capacity of the top level, controls the accuracy (rank error ~ 1/k)
+        :c: capacity decay factor between consecutive levels
+        :seed: seed of the random generator used in the compactions
+        :dtype: dtype of the stored items
+        """
+        if k < 2:
+            raise ValueError("k must be at least 2")
+        self.shape = tuple(int(n) for n in np.atleast_1d(shape))
+        self.ncells = int(np.prod(self.shape))
+        self.k = int(k)
+        self.c = c
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.rank_error = 0
+        self.levels = [np.empty((0, self.ncells), dtype=self.dtype)]
+        self._rng = np.random.default_rng(seed)
+
+    # --------------------------------------------------------------
+    # Building the sketch
+    def _capacity(self, h):
+        """Capacity of level h (top level has capacity k)."""
+        depth = len(self.levels) - 1 - h
+        return max(2, int(np.ceil(self.k * self.c ** depth)))
+
+    def _compress(self):
+        """Compact the levels that exceed their capacity."""
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if level.shape[0] > self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty((0, self.ncells), dtype=self.dtype))
+                level = np.sort(level, axis=0)
+                n_pairs = level.shape[0] // 2 * 2
+                # Each cell keeps the even or the odd items of its sorted level
+                offset = self._rng.integers(0, 2, size=self.ncells, dtype=bool)
+                promoted = np.where(offset, level[1:n_pairs:2], level[0:n_pairs:2])
+                self.levels[h] = level[n_pairs:]
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted], axis=0)
+                # A compaction of level h moves any rank by at most 2**h
+                self.rank_error += 2 ** h
+            h += 1
+
+    def update(self, samples):
+        """
+        Add a block of samples to the sketch.
+        :samples: array of shape (n_samples, *shape)
+        :return: the sketch itself
+        """
+        samples = np.asarray(samples, dtype=self.dtype)
+        if samples.shape[1:] != self.shape:
+            samples = samples.reshape((-1,) + self.shape)
+        samples = samples.reshape(samples.shape[0], self.ncells)
+        if np.isnan(samples).any():
+            raise ValueError("samples contain NaN values")
+        self.levels[0] = np.concatenate([self.levels[0], samples], axis=0)
+        self.count += samples.shape[0]
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """
+        Merge another sketch of the same grid into this one.
+        :other: GridQuantileSketch
+        :return: the sketch itself
+        """
+        if other.shape != self.shape:
+            raise ValueError(f"Cannot merge sketches of shapes {self.shape} and {other.shape}")
+        for h, level in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty((0, self.ncells), dtype=self.dtype))
+            self.levels[h] = np.concatenate([self.levels[h], level.astype(self.dtype)], axis=0)
+        self.count += other.count
+        self.rank_error += other.rank_error
+        self._compress()
+        return self
+
+    # --------------------------------------------------------------
+    # Queries
+    def _weighted_items(self):
+        """Sorted items of every cell with their cumulative weights."""
+        items = np.concatenate(self.levels, axis=0)
+        weights = np.concatenate([np.full(level.shape[0], 2 ** h, dtype=np.int64)
+                                  for h, level in enumerate(self.levels)])
+        order = np.argsort(items, axis=0)
+        items = np.take_along_axis(items, order, axis=0)
+        cumweights = np.cumsum(weights[order], axis=0)
+        return items, cumweights
+
+    def percentile(self, q):
+        """
+        Approximate percentiles of every cell (same convention as np.percentile).
+        :q: percentile or sequence of percentiles in [0, 100]
+        :return: array of shape (*shape) or (len(q), *shape)
+        """
+        if self.count == 0:
+            raise ValueError("The sketch is empty")
+        q = np.asarray(q, dtype=np.float64)
+        if np.any((q < 0) | (q > 100)):
+            raise ValueError("Percentiles must be in the range [0, 100]")
+        items, cumweights = self._weighted_items()
+        total = cumweights[-1]
+        result = []
+        for qi in np.atleast_1d(q):
+            target = qi / 100 * (total - 1)
+            idx = np.minimum((cumweights <= target).sum(axis=0), items.shape[0] - 1)
+            result.append(np.take_along_axis(items, idx[np.newaxis], axis=0)[0])
+        result = np.stack(result).reshape((-1,) + self.shape)
+        return result[0] if q.ndim == 0 else result
+
+    def max_rank_error(self):
+        """Worst-case rank error of any query, as a fraction of the number of samples."""
+        return self.rank_error / self.count if self.count else 0.0
+
+    @property
+    def nbytes(self):
+        """Memory used by the stored items."""
+        return sum(level.nbytes for level in self.levels)
+
+    # --------------------------------------------------------------
+    # Persistence
+    def save(self, path):
+        """Save the sketch to a .npz file."""
+        levels = {f"level_{h}": level for h, level in enumerate(self.levels)}
+        np.savez(path, shape=np.array(self.shape), k=self.k, c=self.c, count=self.count,
+                 rank_error=self.rank_error, **levels)
+
+    @classmethod
+    def load(cls, path, seed=None):
+        """Load a sketch saved with GridQuantileSketch.save."""
+        with np.load(path) as data:
+            n_levels = sum(1 for key in data.files if key.startswith("level_"))
+            levels = [data[f"level_{h}"] for h in range(n_levels)]
+            sketch = cls(tuple(data["shape"]), k=int(data["k"]), c=float(data["c"]),
+                         seed=seed, dtype=levels[0].dtype)
+            sketch.count = int(data["count"])
+            sketch.rank_error = int(data["rank_error"])
+        sketch.levels = levels
+        return sketch
+
+
+def sketch_hindcast(winter_hcst, k=200, seed=None, sample_dim='number', year_dim='start_date'):
+    """
+    Build the per-grid-point sketch of a hindcast reading it year by year.
+    :winter_hcst: xr.DataArray with dimensions (number, start_date, lat, lon)
+    :k: accuracy parameter of the sketch
+    :return: GridQuantileSketch over the (lat, lon) grid
+    """
+    grid_dims = [dim for dim in winter_hcst.dims if dim not in (sample_dim, year_dim)]
+    shape = tuple(winter_hcst.sizes[dim] for dim in grid_dims)
+    sketch = GridQuantileSketch(shape, k=k, seed=seed)
+    n_years = winter_hcst.sizes[year_dim]
+    for t in range(n_years):
+        print(f" - Sketching start date {t + 1}/{n_years}")
+        block = winter_hcst.isel({year_dim: t}).transpose(sample_dim, *grid_dims).values
+        sketch.update(block)
+    return sketch
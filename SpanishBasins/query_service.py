@@ -0,0 +1,223 @@
+"""
+Local HTTP query service for basin anomalies.
+
+Serves the precomputed products of products.py as JSON, entirely offline:
+
+    GET /basins?start_month=10&year=2024                  basins available
+    GET /stats?basin=3&start_month=10&year=2024           STEP5 statistics of a basin
+    GET /members?basin=3&start_month=10&year=2024         per-member forecast anomalies
+    GET /terciles?basin=3&start_month=10&year=2024        tercile probabilities
+    GET /climatology?basin=3&start_month=10               hindcast climatology of a basin
+    GET /metrics                                          latency and cache metrics
+
+Arrays are read memory-mapped and the query results are kept in an LRU cache
+bounded to QUERY_CACHE_SIZE entries. The cached entries are keyed on the
+modification time of the products, so products rewritten by BoxPlot or
+ingest_daemon.py are served as soon as they are written.
+
+Usage: PRODUCTS_DIR=/path/to/products python query_service.py
+       (optional QUERY_HOST, QUERY_PORT and QUERY_CACHE_SIZE, also read from .env)
+"""
+
+import os
+import json
+import time
+import threading
+from functools import lru_cache
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from dotenv import load_dotenv
+
+from anomalies import anomaly_stats
+from climatology import Climatology
+from products import load_basin_products, product_dir, climatology_dir, tercile_probabilities
+
+# Endpoints with their own latency metrics, any other path is recorded as 'other'
+ENDPOINTS = ('basins', 'stats', 'members', 'terciles', 'climatology', 'metrics')
+
+
+class BasinNotFound(KeyError):
+    """Basin not in the products or the climatology (HTTP 404, as a missing product)."""
+
+
+class LatencyMetrics:
+    """Latency of the requests of every endpoint."""
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds):
+        with self.lock:
+            samples = self.samples[endpoint]
+            samples.append(seconds)
+            if len(samples) > self.max_samples:
+                del samples[:len(samples) - self.max_samples]
+
+    def summary(self):
+        with self.lock:
+            summary = {}
+            for endpoint, samples in self.samples.items():
+                ms = np.array(samples) * 1000
+                summary[endpoint] = {
+                    'count': len(ms),
+                    'mean_ms': float(ms.mean()),
+                    'p50_ms': float(np.percentile(ms, 50)),
+                    'p95_ms': float(np.percentile(ms, 95)),
+                    'max_ms': float(ms.max())
+                }
+            return summary
+
+
+class BasinQueries:
+    """Queries over the products directory with an LRU cache of the results."""
+
+    def __init__(self, products_dir, cache_size=256):
+        self.products_dir = products_dir
+        self.metrics = LatencyMetrics()
+        # Cached per instance, bounded to cache_size results; the products and
+        # climatologies are keyed on their modification time (see _version)
+        self._cached_query = lru_cache(maxsize=cache_size)(self._query)
+        self._products = lru_cache(maxsize=32)(self._open_products)
+        self._climatology = lru_cache(maxsize=12)(self._open_climatology)
+
+    def _version(self, endpoint, start_month, year):
+        """
+        Modification time of the file written last when the products (basins.json)
+        or the climatology (climatology.json) are saved, None if missing.
+        """
+        if endpoint == 'climatology':
+            path = os.path.join(climatology_dir(self.products_dir, start_month), 'climatology.json')
+        else:
+            path = os.path.join(product_dir(self.products_dir, start_month, year), 'basins.json')
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def query(self, endpoint, start_month, year=None, basin=None):
+        """Result of a query, from the cache unless the products changed."""
+        return self._cached_query(endpoint, start_month, year, basin,
+                                  self._version(endpoint, start_month, year))
+
+    def _open_products(self, start_month, year, version):
+        meta, hcst, fcst = load_basin_products(self.products_dir, start_month, year)
+        index = {b['id']: n for n, b in enumerate(meta['basins'])}
+        return meta, index, hcst, fcst
+
+    def _open_climatology(self, start_month, version):
+        return Climatology.load(climatology_dir(self.products_dir, start_month))
+
+    def _basin(self, start_month, year, basin, version):
+        meta, index, hcst, fcst = self._products(start_month, year, version)
+        if basin not in index:
+            raise BasinNotFound(f"Basin {basin} not found")
+        n = index[basin]
+        return meta['basins'][n], hcst[n], fcst[n]
+
+    def _query(self, endpoint, start_month, year, basin, version):
+        if endpoint == 'basins':
+            meta = self._products(start_month, year, version)[0]
+            return {'start_month': start_month, 'year': year,
+                    'basins': [{'id': b['id'], 'name': b['name']} for b in meta['basins']]}
+        if endpoint == 'climatology':
+            clim = self._climatology(start_month, version)
+            if clim.basin_points is None or basin not in clim.basin_points:
+                raise BasinNotFound(f"Basin {basin} not in the climatology")
+            index = list(clim.basin_points).index(basin)
+            percentiles = clim.basin_sketch.percentile([5, 25, 50, 75, 95])[:, index]
+            return {'basin': basin, 'name': clim.basin_points[basin]['name'],
+                    'start_month': start_month, 'samples': clim.basin_moments.count,
+                    'mean': float(clim.basin_moments.mean[index]),
+                    'std': float(clim.basin_moments.std()[index]),
+                    'percentiles': dict(zip(['5', '25', '50', '75', '95'], percentiles.tolist()))}
+
+        info, hcst, fcst = self._basin(start_month, year, basin, version)
+        result = {'basin': basin, 'name': info['name'], 'start_month': start_month, 'year': year}
+        if endpoint == 'stats':
+            result['hindcast'] = anomaly_stats(hcst, info['hcst_mean'], info['hcst_std'])
+            result['forecast'] = anomaly_stats(fcst, info['fcst_mean'], info['fcst_std'])
+        elif endpoint == 'members':
+            result['forecast_anomaly'] = fcst.tolist()
+        elif endpoint == 'terciles':
+            result.update(tercile_probabilities(hcst, fcst))
+        else:
+            raise KeyError(f"Unknown endpoint '{endpoint}'")
+        return result
+
+    def cache_info(self):
+        info = self._cached_query.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'maxsize': info.maxsize}
+
+
+def make_handler(queries):
+    """Request handler class bound to a BasinQueries instance."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, status, body):
+            data = json.dumps(body, default=float).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            start = time.perf_counter()
+            url = urlparse(self.path)
+            endpoint = url.path.strip('/')
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            try:
+                if endpoint == 'metrics':
+                    self._send(200, {'latency': queries.metrics.summary(), 'cache': queries.cache_info()})
+                    return
+                start_month = int(params['start_month'])
+                year = int(params['year']) if 'year' in params else None
+                basin = int(params['basin']) if 'basin' in params else None
+                if endpoint != 'climatology' and year is None:
+                    raise KeyError('year')
+                if endpoint not in ('basins',) and basin is None:
+                    raise KeyError('basin')
+                self._send(200, queries.query(endpoint, start_month, year, basin))
+            except (BasinNotFound, FileNotFoundError) as error:
+                self._send(404, {'error': str(error.args[0])})
+            except (KeyError, ValueError) as error:
+                self._send(400, {'error': f"Bad request: {error}"})
+            except Exception as error:
+                self._send(500, {'error': f"Internal error: {type(error).__name__}: {error}"})
+            finally:
+                queries.metrics.record(endpoint if endpoint in ENDPOINTS else 'other',
+                                       time.perf_counter() - start)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(products_dir, host='127.0.0.1', port=8000, cache_size=256):
+    """Run the service until interrupted."""
+    queries = BasinQueries(products_dir, cache_size=cache_size)
+    server = ThreadingHTTPServer((host, port), make_handler(queries))
+    print(f"Serving basin products from {products_dir} at http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    products_dir = os.getenv("PRODUCTS_DIR")
+    if not products_dir:
+        raise ValueError("PRODUCTS_DIR is missing. Please check your .env file.")
+    serve(products_dir,
+          host=os.getenv("QUERY_HOST", "127.0.0.1"),
+          port=int(os.getenv("QUERY_PORT", "8000")),
+          cache_size=int(os.getenv("QUERY_CACHE_SIZE", "256")))
@@ -6,6 +6,9 @@ import xarray as xr
 import numpy as np
 import os
 from dotenv import load_dotenv
+from grib_index import open_grib_selection
+from grib_parallel import open_grib_parallel, parallel_decoding
+from regrid import bilinear_weights, remap_dataset, output_names
 
 # Load environment variables from .env file
 load_dotenv()
@@ -20,7 +23,8 @@ era5_file = os.getenv("ERA5_GRID_FILE")
 if not all([hindcast_input_dir, hindcast_output_dir, forecast_input_dir, forecast_output_dir, era5_file]):
     raise ValueError("Some required environment variables are missing. Please check your .env file.")
 
-# Spatial variables to process
+# Spatial variables to process (GRIB shortNames, e.g. add "2t").
+# All of them are read from each GRIB file and remapped in a single pass.
 spatial_vars = ["tprate"]
 
 # Load the ERA5 grid (0.25-degree resolution)
@@ -29,78 +33,48 @@ era5_reduced = era5.isel(valid_time=0)  # Remove the first dimension
 new_latitudes = np.array(era5_reduced['latitude'])
 new_longitudes = np.array(era5_reduced['longitude'])
 
+# Only the latitudes around the target grid are decoded (one source row of margin)
+region = {'lat': (new_latitudes.min() - 1, new_latitudes.max() + 1)}
+
 def interpolate_hindcast(input_dir, output_dir, new_latitudes, new_longitudes):
     """Interpolate hindcast data to 0.25-degree grid."""
     print("Processing HINDCAST data...")
-    
-    # Open hindcast GRIB file
+
+    # Open hindcast GRIB file, or per-year files matching a glob pattern
+    # (only the messages of spatial_vars)
     hindcast_file = os.path.join(input_dir, 'hindcast_file_name.grib')
-    ds = xr.open_dataset(hindcast_file, engine="cfgrib")
-
-    interpolated_vars = {}
-    for var in spatial_vars:
-        print(f"Processing variable: {var}")
-        interpolated_blocks = []
-        
-        # Process by time blocks
-        for time_idx in range(len(ds['time'])):
-            print(f" - Interpolating year {str(np.array(ds['time'][time_idx]))[:4]} ({time_idx + 1}/{len(ds['time'])})")
-            block = ds[var].isel(time=time_idx)  # Select time block
-            block_interp = block.interp(latitude=new_latitudes, longitude=new_longitudes, method="linear")
-            interpolated_blocks.append(block_interp)
-        
-        # Concatenate interpolated time blocks
-        interpolated_vars[var] = xr.concat(interpolated_blocks, dim='time')
-        print(f"Variable {var} interpolated completely.")
-
-    # Create a new dataset with interpolated variables
-    new_ds = xr.Dataset(
-        interpolated_vars,
-        coords={
-            'number': ds['number'],
-            'time': ds['time'],
-            'step': ds['step'],
-            'latitude': new_latitudes,
-            'longitude': new_longitudes
-        }
-    )
-
-    # Save the interpolated hindcast to NetCDF
+    ds = open_grib_parallel(hindcast_file, spatial_vars, region=region)
+
+    # Remap weights computed once and shared by all the variables
+    weights = bilinear_weights(ds['lat'].values, ds['lon'].values, new_latitudes, new_longitudes)
+
+    # Process by time blocks, all the variables of each block together
+    # The GRIB messages are decoded in a pool of processes
+    with parallel_decoding():
+        new_ds = remap_dataset(ds, weights, spatial_vars, block_dim='start_date')
+    print(f"Variables {spatial_vars} interpolated completely.")
+
+    # Save the interpolated hindcast to NetCDF (latitude/longitude/time coordinates)
     output_file = os.path.join(output_dir, "hindcast_output_file_name.nc")
-    new_ds.to_netcdf(output_file)
+    output_names(new_ds).to_netcdf(output_file)
     print(f"Hindcast NetCDF file created: {output_file}")
 
 def interpolate_forecast(input_dir, output_dir, new_latitudes, new_longitudes):
     """Interpolate forecast data to 0.25-degree grid."""
     print("Processing FORECAST data...")
-    
-    # Open forecast GRIB file
+
+    # Open forecast GRIB file (only the messages of spatial_vars)
     forecast_file = os.path.join(input_dir, 'forecast_file_name.grib')
-    ds = xr.open_dataset(forecast_file, engine="cfgrib")
-
-    interpolated_vars = {}
-    for var in spatial_vars:
-        print(f"Interpolating variable: {var}")
-        interpolated_vars[var] = ds[var].interp(
-            coords={'latitude': new_latitudes, 'longitude': new_longitudes},
-            method="linear"
-        )
-        print(f"Variable {var} interpolated.")
-
-    # Create a new dataset with interpolated variables
-    new_ds = xr.Dataset(
-        interpolated_vars,
-        coords={
-            'number': ds['number'],
-            'step': ds['step'],
-            'latitude': new_latitudes,
-            'longitude': new_longitudes
-        }
-    )
-
-    # Save the interpolated forecast to NetCDF
+    ds = open_grib_selection(forecast_file, spatial_vars, region=region)
+
+    # Remap weights computed once and shared by all the variables
+    weights = bilinear_weights(ds['lat'].values, ds['lon'].values, new_latitudes, new_longitudes)
+    new_ds = remap_dataset(ds, weights, spatial_vars)
+    print(f"Variables {spatial_vars} interpolated.")
+
+    # Save the interpolated forecast to NetCDF (latitude/longitude/time coordinates)
     output_file = os.path.join(output_dir, "forecast_output_file_name.nc")
-    new_ds.to_netcdf(output_file)
+    output_names(new_ds).to_netcdf(output_file)
     print(f"Forecast NetCDF file created: {output_file}")
 
 # Execute hindcast and forecast interpolation
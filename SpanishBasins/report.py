@@ -0,0 +1,163 @@
+"""
+Basin anomaly report: one document instead of a 300 dpi PNG per basin and year.
+
+The boxplots and statistics tables of every basin (or vertiente) and forecast
+year are collected with BasinReport.add and written at the end as
+
+    - a multi-page PDF: vector boxplots drawn on one reused figure, with the
+      statistics table written as monospaced text instead of a table axes;
+    - a self-contained HTML file: one shared stylesheet, boxplots as small
+      inline SVG drawings built from the box statistics, and HTML tables.
+
+Both show the same boxes as STEP6 of BoxPlot_HindcastForecast.py
+(whiskers at the furthest samples within 1.5 IQR, no fliers).
+"""
+
+import html
+import numpy as np
+
+# Colours of the STEP6 boxplots
+BOX_FACE, BOX_EDGE, MEDIAN_COLOR = "#add8e6", "#00008b", "#ffa500"
+
+HTML_STYLE = """
+body { font-family: sans-serif; margin: 2em; }
+section { page-break-inside: avoid; border-top: 1px solid #ccc; padding: 1em 0; display: flex; gap: 2em; align-items: center; }
+h1 { font-size: 1.4em; } h2 { font-size: 1.1em; margin: 0 0 0.5em 0; }
+table { border-collapse: collapse; font-size: 0.85em; }
+th, td { border: 1px solid #ccc; padding: 2px 8px; text-align: right; }
+th { background: #cfe2f3; }
+.box { fill: #add8e6; stroke: #00008b; } .whisker { stroke: #00008b; } .median { stroke: #ffa500; stroke-width: 2; }
+.axis { stroke: #444; } .grid { stroke: #ddd; } text { font-size: 11px; }
+"""
+
+
+# Formats written by BasinReport.write
+REPORT_FORMATS = ('pdf', 'html')
+
+
+def parse_formats(value):
+    """
+    Report formats from a comma-separated string such as 'pdf, html'.
+    Checked when the scripts start, not after the whole run.
+    """
+    formats = [fmt.strip().lower() for fmt in value.split(',') if fmt.strip()]
+    unknown = [fmt for fmt in formats if fmt not in REPORT_FORMATS]
+    if unknown or not formats:
+        raise ValueError(f"Unknown report formats {unknown or value!r}, use any of {', '.join(REPORT_FORMATS)}")
+    return formats
+
+
+def box_stats(values):
+    """
+    Box statistics as drawn by matplotlib boxplot (whis=1.5).
+    :return: dict with whislo, q1, med, q3, whishi
+    """
+    values = np.asarray(values, dtype=np.float64)
+    q1, med, q3 = np.percentile(values, [25, 50, 75])
+    iqr = q3 - q1
+    inside_low = values[values >= q1 - 1.5 * iqr]
+    inside_high = values[values <= q3 + 1.5 * iqr]
+    return {'whislo': inside_low.min() if len(inside_low) else q1, 'q1': q1, 'med': med, 'q3': q3,
+            'whishi': inside_high.max() if len(inside_high) else q3}
+
+
+class BasinReport:
+    """Boxplots and statistics tables of many basins and years in one document."""
+
+    def __init__(self, title, ylabel="Precipitation Anomaly (%)"):
+        self.title = title
+        self.ylabel = ylabel
+        self.pages = []
+
+    def add(self, heading, series, stats_df, notes=None):
+        """
+        Add a page.
+        :heading: title of the page (basin, start month, period...)
+        :series: dict box label -> samples, e.g. {"Reference\\n1993-2016": hcst, "Forecast\\n2023/2024": fcst}
+        :stats_df: pd.DataFrame of the statistics table (STEP5)
+        :notes: optional pd.DataFrame shown under the table (e.g. confidence intervals)
+        """
+        boxes = {label: box_stats(values) for label, values in series.items()}
+        self.pages.append({'heading': heading, 'boxes': boxes, 'stats': stats_df, 'notes': notes})
+
+    def write_pdf(self, path):
+        """Write all the pages to a multi-page PDF."""
+        from matplotlib import pyplot as plt
+        from matplotlib.backends.backend_pdf import PdfPages
+
+        fig = plt.figure(figsize=(11.7, 8.3))  # A4 landscape, reused for every page
+        with PdfPages(path) as pdf:
+            for page in self.pages:
+                fig.clear()
+                fig.suptitle(page['heading'], fontsize=13)
+                ax = fig.add_axes([0.07, 0.12, 0.45, 0.7])
+                ax.bxp(list(page['boxes'].values()), showfliers=False, widths=0.4, patch_artist=True,
+                       boxprops=dict(facecolor=BOX_FACE, color=BOX_EDGE),
+                       medianprops=dict(color=MEDIAN_COLOR, linewidth=1.5),
+                       whiskerprops=dict(color=BOX_EDGE), capprops=dict(color=BOX_EDGE))
+                ax.set_xticks(range(1, len(page['boxes']) + 1), list(page['boxes']))
+                ax.set_ylabel(self.ylabel, fontsize=11)
+                ax.grid(axis='y', color='lightgray', linewidth=0.5)
+                # Tables as text
+                text = page['stats'].to_string()
+                if page['notes'] is not None:
+                    text += "\n\n" + page['notes'].to_string()
+                fig.text(0.56, 0.82, text, family='monospace', fontsize=7.5, va='top')
+                pdf.savefig(fig)
+            pdf.infodict()['Title'] = self.title
+        plt.close(fig)
+        print(f"Report saved at {path}")
+
+    def _svg_boxplot(self, boxes, width=360, height=260):
+        """Inline SVG boxplot of a page."""
+        low = min(b['whislo'] for b in boxes.values())
+        high = max(b['whishi'] for b in boxes.values())
+        pad = 0.05 * (high - low or 1)
+        low, high = low - pad, high + pad
+        left, right, top, bottom = 50, width - 10, 10, height - 40
+
+        def y(v):
+            return bottom - (v - low) / (high - low) * (bottom - top)
+
+        parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">']
+        for tick in np.linspace(low, high, 6):
+            parts.append(f'<line class="grid" x1="{left}" x2="{right}" y1="{y(tick):.1f}" y2="{y(tick):.1f}"/>'
+                         f'<text x="{left - 4}" y="{y(tick) + 4:.1f}" text-anchor="end">{tick:.1f}</text>')
+        parts.append(f'<line class="axis" x1="{left}" x2="{left}" y1="{top}" y2="{bottom}"/>')
+        step = (right - left) / len(boxes)
+        for n, (label, b) in enumerate(boxes.items()):
+            cx, half = left + step * (n + 0.5), step * 0.2
+            parts.append(
+                f'<line class="whisker" x1="{cx}" x2="{cx}" y1="{y(b["whislo"]):.1f}" y2="{y(b["q1"]):.1f}"/>'
+                f'<line class="whisker" x1="{cx}" x2="{cx}" y1="{y(b["q3"]):.1f}" y2="{y(b["whishi"]):.1f}"/>'
+                f'<line class="whisker" x1="{cx - half / 2}" x2="{cx + half / 2}" y1="{y(b["whislo"]):.1f}" y2="{y(b["whislo"]):.1f}"/>'
+                f'<line class="whisker" x1="{cx - half / 2}" x2="{cx + half / 2}" y1="{y(b["whishi"]):.1f}" y2="{y(b["whishi"]):.1f}"/>'
+                f'<rect class="box" x="{cx - half}" y="{y(b["q3"]):.1f}" width="{2 * half}" height="{y(b["q1"]) - y(b["q3"]):.1f}"/>'
+                f'<line class="median" x1="{cx - half}" x2="{cx + half}" y1="{y(b["med"]):.1f}" y2="{y(b["med"]):.1f}"/>')
+            for k, line in enumerate(label.split("\n")):
+                parts.append(f'<text x="{cx}" y="{bottom + 15 + 12 * k}" text-anchor="middle">{html.escape(line)}</text>')
+        parts.append('</svg>')
+        return "".join(parts)
+
+    def write_html(self, path):
+        """Write all the pages to a self-contained HTML file."""
+        body = [f"<h1>{html.escape(self.title)}</h1>", f"<p>{html.escape(self.ylabel)}</p>"]
+        for page in self.pages:
+            tables = page['stats'].to_html(float_format=lambda v: f"{v:.2f}")
+            if page['notes'] is not None:
+                tables += page['notes'].to_html(float_format=lambda v: f"{v:.2f}")
+            heading = html.escape(page['heading']).replace("\n", "<br>")
+            body.append(f"<section><div><h2>{heading}</h2>{self._svg_boxplot(page['boxes'])}</div>"
+                        f"<div>{tables}</div></section>")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{html.escape(self.title)}</title>'
+                    f'<style>{HTML_STYLE}</style></head><body>{"".join(body)}</body></html>')
+        print(f"Report saved at {path}")
+
+    def write(self, path_without_extension, formats=('pdf',)):
+        """Write the report in the given formats ('pdf', 'html')."""
+        writers = {'pdf': self.write_pdf, 'html': self.write_html}
+        for fmt in formats:
+            if fmt not in writers:
+                raise ValueError(f"Unknown report format '{fmt}'")
+            writers[fmt](f"{path_without_extension}.{fmt}")
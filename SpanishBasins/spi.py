@@ -0,0 +1,166 @@
+"""
+Standardized precipitation index (SPI) from gamma fits of the hindcast.
+
+The hindcast precipitation of every grid cell (or basin) is fitted with a mixed
+distribution: a probability q of zero precipitation and a gamma distribution
+of the positive values. The gamma shape and scale come from the Thom (1958)
+approximation of the maximum-likelihood estimates,
+
+    A = ln(mean(x)) - mean(ln(x)),   shape = (1 + sqrt(1 + 4A/3)) / 4A,   scale = mean(x) / shape
+
+which only needs running sums, so all the cells are fitted at once and block
+by block. SPI = Phi^-1(q + (1 - q) G(x; shape, scale)), with Phi the standard
+normal distribution and G the gamma distribution, clipped to +-SPI_LIMIT.
+"""
+
+import numpy as np
+import xarray as xr
+from scipy.special import gammainc, ndtri
+
+from blocking import sample_blocks
+from products import atomic_write
+
+# Usual bound of the SPI values (probabilities of about 0.001 and 0.999)
+SPI_LIMIT = 3.09
+
+
+class GammaAccumulator:
+    """Running sums needed by the gamma fit of every cell."""
+
+    def __init__(self, shape):
+        self.shape = tuple(int(n) for n in np.atleast_1d(shape))
+        self.count = 0
+        self.n_positive = np.zeros(self.shape, dtype=np.int64)
+        self.sum = np.zeros(self.shape, dtype=np.float64)
+        self.sum_log = np.zeros(self.shape, dtype=np.float64)
+
+    def update(self, samples):
+        """
+        Add a block of samples.
+        :samples: array of shape (n_samples, *shape)
+        """
+        samples = np.asarray(samples)
+        positive = samples > 0
+        self.count += samples.shape[0]
+        self.n_positive += positive.sum(axis=0)
+        self.sum += np.where(positive, samples, 0).sum(axis=0, dtype=np.float64)
+        self.sum_log += np.log(np.where(positive, samples, 1), dtype=np.float64).sum(axis=0)
+        return self
+
+    def merge(self, other):
+        """Merge the sums of another accumulator of the same shape."""
+        if other.shape != self.shape:
+            raise ValueError(f"Cannot merge accumulators of shapes {self.shape} and {other.shape}")
+        self.count += other.count
+        self.n_positive += other.n_positive
+        self.sum += other.sum
+        self.sum_log += other.sum_log
+        return self
+
+    def fit(self):
+        """Gamma parameters of every cell (NaN where fewer than two positive samples)."""
+        return GammaParameters.from_sums(self.count, self.n_positive, self.sum, self.sum_log)
+
+
+class GammaParameters:
+    """Probability of zero, gamma shape and gamma scale of every cell."""
+
+    def __init__(self, q_zero, shape, scale):
+        self.q_zero = np.asarray(q_zero, dtype=np.float64)
+        self.shape = np.asarray(shape, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+
+    @classmethod
+    def from_sums(cls, count, n_positive, total, total_log):
+        """Thom estimates from the sums of the positive samples."""
+        valid = n_positive >= 2
+        n = np.where(valid, n_positive, 1)
+        mean = np.where(valid, total / n, np.nan)
+        a = np.log(mean) - total_log / n
+        valid &= a > 0  # constant cells have no gamma fit
+        a = np.where(valid, a, np.nan)
+        shape = (1 + np.sqrt(1 + 4 * a / 3)) / (4 * a)
+        return cls(1 - n_positive / count, shape, mean / shape)
+
+    @classmethod
+    def fit(cls, samples):
+        """Gamma parameters of samples (n_samples, *shape) held in memory."""
+        samples = np.asarray(samples)
+        return GammaAccumulator(samples.shape[1:]).update(samples).fit()
+
+    def save(self, path):
+        """Save the parameters to a .npz file (atomically, see products.atomic_write)."""
+        atomic_write(path, lambda tmp: np.savez(tmp, q_zero=self.q_zero, shape=self.shape, scale=self.scale))
+
+    @classmethod
+    def load(cls, path):
+        """Load parameters saved with GammaParameters.save."""
+        with np.load(path) as data:
+            return cls(data['q_zero'], data['shape'], data['scale'])
+
+
+def spi(values, params, dtype=np.float64):
+    """
+    SPI values of precipitation samples.
+    :values: array (..., *cells) broadcastable against the parameters
+    :params: GammaParameters of the cells
+    :return: array of SPI values, NaN where the cell has no gamma fit
+    """
+    values = np.asarray(values, dtype=np.float64)
+    cdf = gammainc(params.shape, np.maximum(values, 0) / params.scale)
+    probability = params.q_zero + (1 - params.q_zero) * cdf
+    return np.clip(ndtri(probability), -SPI_LIMIT, SPI_LIMIT).astype(dtype, copy=False)
+
+
+def fit_grid(winter_hcst_stacked, memory_budget, sample_dim='new_dim', dtype=np.float32):
+    """
+    Gamma parameters of every grid cell, reading the hindcast in blocks of samples.
+    :winter_hcst_stacked: xr.DataArray (sample_dim, lat, lon)
+    :return: GammaParameters of shape (lat, lon)
+    """
+    n_lat, n_lon = winter_hcst_stacked.sizes['lat'], winter_hcst_stacked.sizes['lon']
+    lat_idx, lon_idx = np.meshgrid(np.arange(n_lat), np.arange(n_lon), indexing='ij')
+    lat_idx = xr.DataArray(lat_idx.ravel(), dims='point')
+    lon_idx = xr.DataArray(lon_idx.ravel(), dims='point')
+    sums = GammaAccumulator(n_lat * n_lon)
+    for values in sample_blocks(winter_hcst_stacked, sample_dim, lat_idx, lon_idx, memory_budget, dtype):
+        sums.update(values)
+    params = sums.fit()
+    return GammaParameters(*(p.reshape(n_lat, n_lon) for p in (params.q_zero, params.shape, params.scale)))
+
+
+def grid_spi(winter_fcst, params, memory_budget, sample_dim='number', dtype=np.float32):
+    """
+    SPI of every member and grid cell, reading the data in blocks of samples.
+    :winter_fcst: xr.DataArray (sample_dim, lat, lon)
+    :params: GammaParameters of shape (lat, lon) (fit_grid)
+    :return: array (sample_dim, lat, lon) of SPI values in dtype
+    """
+    n_lat, n_lon = winter_fcst.sizes['lat'], winter_fcst.sizes['lon']
+    lat_idx, lon_idx = np.meshgrid(np.arange(n_lat), np.arange(n_lon), indexing='ij')
+    lat_idx = xr.DataArray(lat_idx.ravel(), dims='point')
+    lon_idx = xr.DataArray(lon_idx.ravel(), dims='point')
+    flat = GammaParameters(*(p.ravel() for p in (params.q_zero, params.shape, params.scale)))
+    out = np.empty((winter_fcst.sizes[sample_dim], n_lat * n_lon), dtype=dtype)
+    start = 0
+    for values in sample_blocks(winter_fcst, sample_dim, lat_idx, lon_idx, memory_budget, dtype):
+        out[start:start + len(values)] = spi(values, flat, dtype=dtype)
+        start += len(values)
+    return out.reshape(-1, n_lat, n_lon)
+
+
+def basin_spi(results, params=None):
+    """
+    SPI of the basin means of every sample, fitted on the hindcast of each basin.
+    :results: dict key -> dict with hcst_basinmean and fcst_basinmean
+              (anomalies.blocked_basin_anomalies or hierarchy.aggregate_hierarchy)
+    :params: cached GammaParameters of shape (keys,), fitted when None
+    :return: (dict key -> {'hindcast_spi', 'forecast_spi'}, GammaParameters of shape (keys,))
+    """
+    keys = list(results)
+    hcst = np.stack([np.asarray(results[k]['hcst_basinmean']) for k in keys], axis=1)  # (samples, keys)
+    fcst = np.stack([np.asarray(results[k]['fcst_basinmean']) for k in keys], axis=1)
+    params = GammaParameters.fit(hcst) if params is None else params
+    hcst_spi, fcst_spi = spi(hcst, params), spi(fcst, params)
+    return ({k: {'hindcast_spi': hcst_spi[:, n], 'forecast_spi': fcst_spi[:, n]} for n, k in enumerate(keys)},
+            params)
@@ -10,6 +10,7 @@ import geopandas as gpd
 import xskillscore as xs
 from dateutil.relativedelta import relativedelta
 from shapely.geometry import Point, box
+from geometry_cache import load_basins, basin_grid_points
 import warnings
 warnings.filterwarnings('ignore')
 import matplotlib.pyplot as plt
@@ -27,7 +28,10 @@ results_path = '/sclim/cly/basins/results-basins'
 
 shapefile_basins = 'DemarcacionesHidrograficasPHC2015_2021.shp'
 shapefile = os.path.join(shapefile_path, shapefile_basins)
-basins = gpd.read_file(shapefile)
+# Cuencas desde la caché de geometrías (se construye desde el shapefile la primera vez)
+geometry_cache_path = os.path.join(shapefile_path, 'geometry-cache')
+basins = load_basins(geometry_cache_path, 'exact', shapefile=shapefile)
+basins_plot = load_basins(geometry_cache_path, 'plot')  # simplificadas para dibujar
 
 #grib_data = '/MASIVO/cly/Seasonal_Verification/1-Sf_variables/data/ecmwf_s51_stmonth09_hindcast1993-2016_monthly.grib'
 #grib_data = '/MASIVO/cly/Forecast/1-Default_forecast/grib-data/ecmwf_s51_stmonth05_forecast2024_monthly.grib'
@@ -67,31 +71,23 @@ for i, basin in basins.iterrows():
 
     ############# CALCULOS ###################
     # Calcular el centroide de la cuenca y el punto de malla más cercano
-    basin_centroid = basin.geometry.centroid
-    distance, idx = tree.query([basin_centroid.x, basin_centroid.y])
+    distance, idx = tree.query([basin['centroid_x'], basin['centroid_y']])
     nearest_lon, nearest_lat = grid_points[idx]
 
-    print(f"El centro de la cuenca es => Longitude: {basin_centroid.x}, Latitude: {basin_centroid.y}")
+    print(f"El centro de la cuenca es => Longitude: {basin['centroid_x']}, Latitude: {basin['centroid_y']}")
     print(f"El punto de grid más cercano es - Longitude: {nearest_lon}, Latitude: {nearest_lat}, Distance: {distance} degrees")
 
     ############# PUNTOS DEL GRID EN LA CUENCA ###################
-    # Crear una lista para almacenar los puntos dentro de la cuenca
-    points_within_basin = []
-
-    # Iterar a través de cada punto en la malla para encontrar los puntos dentro de la geometría de la cuenca
-    for lat_idx, lat in enumerate(lats):
-        for lon_idx, lon in enumerate(lons):
-            point = Point(lon, lat)
-
-            # Comprobar si el punto está dentro de la geometría de la cuenca
-            if basin.geometry.contains(point):
-                points_within_basin.append({
-                    "x_grid": lat_idx,
-                    "y_grid": lon_idx,
-                    "latitude": lat,
-                    "longitude": lon,
-                    "basin_name": basin_name
-                })
+    # Comprobar de una vez qué puntos de la malla están dentro de la geometría exacta de la cuenca
+    # (las geometrías simplificadas solo se usan para dibujar)
+    lat_idx, lon_idx = basin_grid_points(basin.geometry, lats, lons)
+    points_within_basin = [{
+        "x_grid": la,
+        "y_grid": lo,
+        "latitude": lats[la],
+        "longitude": lons[lo],
+        "basin_name": basin_name
+    } for la, lo in zip(lat_idx, lon_idx)]
 
     # Si no se encontraron puntos dentro de la cuenca, agregar el punto de malla más cercano al centroide
     if not points_within_basin:
@@ -120,8 +116,8 @@ for i, basin in basins.iterrows():
     fig.subplots_adjust(wspace=0.05)
 
     # Crear la gráfica de la cuenca
-    basins.plot(ax=ax_map, color='lightblue', edgecolor='black', alpha=0.5)  # Pintar las demás cuencas en gris
-    gpd.GeoDataFrame(geometry=[basin.geometry]).plot(ax=ax_map, color='none', edgecolor='red', linewidth=2)  # Cuenca seleccionada en rojo
+    basins_plot.plot(ax=ax_map, color='lightblue', edgecolor='black', alpha=0.5)  # Pintar las demás cuencas en gris
+    basins_plot.iloc[[i]].plot(ax=ax_map, color='none', edgecolor='red', linewidth=2)  # Cuenca seleccionada en rojo
     ax_map.set_title(f"Basin {i + 1}: " + str(basin['nameTxtInt']) if 'nameTxtInt' in basin else f"Basin {i + 1}")
     ax_map.set_xlabel("Grid Lon")
     ax_map.set_ylabel("Grid Lat")
@@ -0,0 +1,70 @@
+"""
+Per-variable unit conversions.
+
+UNIT_CONVERSIONS maps a GRIB shortName to the function converting it to the
+units used in the basin products. New variables are added with
+register_conversion, e.g.:
+
+    register_conversion('msl', lambda data: data / 100, 'hPa')
+"""
+
+
+def convert_precip_units(data):
+    """
+    This function converts precipitation units from m/s to l/m^2.
+    :data: matrix of precipitation
+    :return: matrix of precipitation in l/m^2
+    """
+    #seconds_per_day = 86400
+    #days_in_month = {1: 31, 2: 29 if leap_year else 28, 3: 31, 4: 30, 5: 31, 6: 30,
+    #                7: 31, 8: 31, 9: 30, 10: 31, 11: 30, 12: 31}
+    # meters per second to meters per month
+    data_m_month = data * 86400 * 30
+    # meters per month to mm per month
+    return data_m_month * 1000
+
+
+def convert_era5_precip_units(data):
+    """
+    This function converts ERA5 monthly averaged precipitation from m/day to l/m^2.
+    :data: matrix of precipitation
+    :return: matrix of precipitation in l/m^2 (30-day months, as convert_precip_units)
+    """
+    return data * 30 * 1000
+
+
+def kelvin_to_celsius(data):
+    """
+    This function converts temperature units from K to ºC.
+    :data: matrix of temperature
+    :return: matrix of temperature in ºC
+    """
+    return data - 273.15
+
+
+# shortName -> (conversion function, units after the conversion)
+UNIT_CONVERSIONS = {
+    'tprate': (convert_precip_units, 'l/m^2'),
+    'tp': (convert_era5_precip_units, 'l/m^2'),
+    '2t': (kelvin_to_celsius, 'degC'),
+}
+
+
+def register_conversion(var, func, units):
+    """Register (or replace) the unit conversion of a variable."""
+    UNIT_CONVERSIONS[var] = (func, units)
+
+
+def convert_units(ds, variables=None):
+    """
+    Convert the variables of a xr.Dataset that have a registered conversion.
+    :variables: variables to convert, all the data variables by default
+    :return: new xr.Dataset; variables without a conversion are left unchanged
+    """
+    variables = list(ds.data_vars) if variables is None else variables
+    converted = {}
+    for var in variables:
+        if var in UNIT_CONVERSIONS:
+            func, units = UNIT_CONVERSIONS[var]
+            converted[var] = func(ds[var]).assign_attrs(ds[var].attrs, units=units)
+    return ds.assign(converted)